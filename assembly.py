@@ -0,0 +1,120 @@
+import os
+import json
+import trimesh
+
+from concurrent.futures import ProcessPoolExecutor
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from stlstream import isLargeBinaryStl, loadStreamed
+from geometry import CompactMesh, loadCompact
+from occlusion import loadOcclusion
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def repairMesh(tmesh):
+    # Fix normals
+    trimesh.repair.fix_winding(tmesh)
+    trimesh.repair.fix_normals(tmesh)
+    trimesh.repair.fill_holes(tmesh)
+    return tmesh
+
+
+def buildGeometry(fileName):
+    # Too big to repair in memory, stream it into a welded, mapped mesh and
+    # quantize that a chunk at a time instead
+    if isLargeBinaryStl(fileName):
+        return loadStreamed(fileName)
+    return CompactMesh.fromTrimesh(repairMesh(trimesh.load(fileName)))
+
+
+def loadGeometry(fileName):
+    # With its baked occlusion, if that was done for this version of the file
+    geometry = loadCompact(fileName, buildGeometry)
+    geometry.occlusion = loadOcclusion(fileName, len(geometry.positions))
+    return geometry
+
+
+def loadPart(fileName):
+    # Runs inside the worker processes, the compact geometry is also a lot
+    # cheaper to pickle back than a whole Trimesh with its caches. A file
+    # that fails comes back with the error instead, so one bad part doesn't
+    # take the rest of the assembly down with it
+    try:
+        return fileName, loadGeometry(fileName), None
+    except Exception as e:
+        return fileName, None, f"{type(e).__name__}: {e}"
+
+
+def findStlFiles(folder):
+    found = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith('.stl'):
+                found.append(os.path.join(root, name))
+    return found
+
+
+def loadManifest(folder, manifestName=MANIFEST_NAME):
+    """
+    Placement manifest, keyed by the STL path relative to the folder:
+
+        {"fixtures/base.stl": {"translation": [0, 0, 0], "rotation": [0, 0, 90]}}
+    """
+    path = os.path.join(folder, manifestName)
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path) as f:
+        entries = json.load(f)
+
+    manifest = {}
+    for name, placement in entries.items():
+        key = os.path.normpath(name)
+        manifest[key] = (
+            tuple(placement.get('translation', (0, 0, 0))),
+            tuple(placement.get('rotation', (0, 0, 0))))
+    return manifest
+
+
+def importAssembly(folder, workers=None):
+    # ([(fileName, geometry, placement), ...], [(fileName, error), ...])
+    files = findStlFiles(folder)
+    manifest = loadManifest(folder)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunksize = max(1, len(files) // (workers * 4))
+
+    parts = []
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for fileName, geometry, error in pool.map(loadPart, files, chunksize=chunksize):
+            if error is not None:
+                failures.append((fileName, error))
+                continue
+            placement = manifest.get(os.path.relpath(fileName, folder))
+            parts.append((fileName, geometry, placement))
+    return parts, failures
+
+
+class AssemblyImporter(QThread):
+    # Emits the parts that loaded, (fileName, geometry, placement), and the
+    # files that didn't, (fileName, error), once every part is repaired.
+    # Always emits, even when the import as a whole fails
+    loaded = pyqtSignal(list, list)
+
+    def __init__(self, folder, workers=None, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+        self.workers = workers
+
+    def run(self):
+        try:
+            parts, failures = importAssembly(self.folder, self.workers)
+        except Exception as e:
+            parts, failures = [], [(self.folder, f"{type(e).__name__}: {e}")]
+        self.loaded.emit(parts, failures)
@@ -0,0 +1,524 @@
+import weakref
+import numpy as np
+
+
+def boxCorners(lo, hi):
+    # (n, 8, 3) corners of n axis aligned boxes
+    mask = np.array([[(i >> axis) & 1 for axis in range(3)] for i in range(8)], dtype=bool)
+    return np.where(mask[None], hi[:, None], lo[:, None])
+
+
+def placeBoxes(lo, hi, transforms):
+    # Conservative boxes around n boxes each placed by its own transform,
+    # from the centre and half extent rather than all eight corners
+    centre = np.einsum('nij,nj->ni', transforms[..., :3, :3], 0.5 * (lo + hi)) + transforms[..., :3, 3]
+    half = np.einsum('nij,nj->ni', np.abs(transforms[..., :3, :3]), 0.5 * (hi - lo))
+    return centre - half, centre + half
+
+
+def boxesOverlap(alo, ahi, blo, bhi):
+    return np.all((alo <= bhi) & (blo <= ahi), axis=-1)
+
+
+def rayEnters(lo, hi, origin, inverse, tMax):
+    # Where a single ray enters a box before tMax, or None. Plain floats,
+    # for one ray numpy's per call overhead is the whole cost
+    tNear = 0.0
+    tFar = tMax
+    for axis in range(3):
+        if inverse[axis] is None:
+            if origin[axis] < lo[axis] or origin[axis] > hi[axis]:
+                return None
+            continue
+        t0 = (lo[axis] - origin[axis]) * inverse[axis]
+        t1 = (hi[axis] - origin[axis]) * inverse[axis]
+        if t0 > t1:
+            t0, t1 = t1, t0
+        tNear = max(tNear, t0)
+        tFar = min(tFar, t1)
+        if tNear > tFar:
+            return None
+    return tNear
+
+
+def rayTriangles(origins, directions, triangles, eps=1e-12):
+    # Moller-Trumbore for n ray/triangle pairs, distance along each ray or inf
+    e1 = triangles[:, 1] - triangles[:, 0]
+    e2 = triangles[:, 2] - triangles[:, 0]
+    h = np.cross(directions, e2)
+    a = np.einsum('ij,ij->i', e1, h)
+    ok = np.abs(a) > eps * np.linalg.norm(e1, axis=1) * np.linalg.norm(e2, axis=1) * np.linalg.norm(directions, axis=1)
+    f = 1.0 / np.where(ok, a, 1.0)
+
+    s = origins - triangles[:, 0]
+    u = f * np.einsum('ij,ij->i', s, h)
+    q = np.cross(s, e1)
+    v = f * np.einsum('ij,ij->i', directions, q)
+    t = f * np.einsum('ij,ij->i', e2, q)
+
+    hit = ok & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+    return np.where(hit, t, np.inf)
+
+
+def rayTrianglesFrom(origin, direction, triangles, eps=1e-12):
+    # rayTriangles for one ray against a handful of triangles, written out
+    # per component since numpy's per call overhead is most of the cost here
+    ox, oy, oz = origin
+    dx, dy, dz = direction
+    v0 = triangles[:, 0]
+    e1 = triangles[:, 1] - v0
+    e2 = triangles[:, 2] - v0
+    e1x, e1y, e1z = e1.T
+    e2x, e2y, e2z = e2.T
+
+    hx = dy * e2z - dz * e2y
+    hy = dz * e2x - dx * e2z
+    hz = dx * e2y - dy * e2x
+    a = e1x * hx + e1y * hy + e1z * hz
+    ok = np.abs(a) > eps * np.sqrt((e1 * e1).sum(axis=1) * (e2 * e2).sum(axis=1) * (dx * dx + dy * dy + dz * dz))
+    f = 1.0 / np.where(ok, a, 1.0)
+
+    sx = ox - v0[:, 0]
+    sy = oy - v0[:, 1]
+    sz = oz - v0[:, 2]
+    u = f * (sx * hx + sy * hy + sz * hz)
+    qx = sy * e1z - sz * e1y
+    qy = sz * e1x - sx * e1z
+    qz = sx * e1y - sy * e1x
+    v = f * (dx * qx + dy * qy + dz * qz)
+    t = f * (e2x * qx + e2y * qy + e2z * qz)
+
+    hit = ok & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0)
+    return np.where(hit, t, np.inf)
+
+
+def trianglesIntersect(a, b, eps=1e-6):
+    # For n triangle pairs, True where they properly cross. Two triangles that
+    # cross have their intersection segment ending on an edge of one of them,
+    # so edge/triangle tests both ways cover it. Edges ending exactly on the
+    # other face and coplanar faces are contact, not interference.
+    hit = np.zeros(len(a), dtype=bool)
+    for first, second in ((a, b), (b, a)):
+        for i in range(3):
+            p0 = first[:, i]
+            d = first[:, (i + 1) % 3] - p0
+            t = rayTriangles(p0, d, second)
+            hit |= (t > eps) & (t < 1 - eps)
+    return hit
+
+
+# Rays for inside/outside tests go this way, skewed so they practically
+# never run exactly through an edge or a vertex of axis aligned geometry
+PARITY_DIRECTION = np.array([0.5773, 0.5774, 0.5775]) / np.linalg.norm([0.5773, 0.5774, 0.5775])
+
+
+def mortonCodes(points, bits=21):
+    # Interleaved bits of the quantized coordinates, sorting by these puts
+    # points close in space close in the order
+    lo = points.min(axis=0)
+    extent = (points.max(axis=0) - lo).max() or 1.0
+    q = ((points - lo) / extent * ((1 << bits) - 1)).astype(np.uint64)
+
+    # Spread each coordinate's bits three apart
+    for shift, mask in ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), (8, 0x100f00f00f00f00f),
+                        (4, 0x10c30c30c30c30c3), (2, 0x1249249249249249)):
+        q = (q | (q << np.uint64(shift))) & np.uint64(mask)
+    return (q[:, 0] << np.uint64(2)) | (q[:, 1] << np.uint64(1)) | q[:, 2]
+
+
+def highestBit(x):
+    # Position of the highest set bit of each of the (non zero) uint64s
+    x = x.copy()
+    bit = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        up = (x >> np.uint64(shift)) > 0
+        x[up] >>= np.uint64(shift)
+        bit += up * shift
+    return bit
+
+
+class BVH():
+    """
+    Flattened bounding volume hierarchy over a set of boxes. Items are put in
+    Morton order once and every node splits its range where the highest bit
+    of the codes changes, the way a linear BVH does, so each node is a cell
+    of an implicit octree and never straddles two far apart clusters. Nodes
+    are built breadth first a whole level at a time. Leaves refer to a
+    contiguous range of self.order, refit() updates the bounds in place when
+    the items move.
+    """
+
+    def __init__(self, itemLo, itemHi, leafSize=8):
+        itemLo = np.asarray(itemLo, dtype=np.float64).reshape(-1, 3)
+        itemHi = np.asarray(itemHi, dtype=np.float64).reshape(-1, 3)
+        n = len(itemLo)
+
+        codes = mortonCodes(0.5 * (itemLo + itemHi)) if n else np.zeros(0, dtype=np.uint64)
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+
+        # A zero row past the end lets the last range end at n
+        boxes = np.concatenate([np.concatenate([itemLo, itemHi], axis=1)[order], np.zeros((1, 6))])
+
+        levels = []
+        ids = np.zeros(1, dtype=np.int64)
+        starts = np.zeros(1, dtype=np.int64)
+        counts = np.array([n])
+        nodeCount = 1
+        depth = 0
+        while True:
+            bounds = np.column_stack([starts, starts + counts]).ravel()
+            lo = np.minimum.reduceat(boxes[:, :3], bounds)[::2]
+            hi = np.maximum.reduceat(boxes[:, 3:], bounds)[::2]
+            empty = counts == 0
+            lo[empty] = 0
+            hi[empty] = 0
+
+            split = counts > leafSize
+            k = np.count_nonzero(split)
+
+            left = np.zeros(len(ids), dtype=np.int64)
+            right = np.zeros(len(ids), dtype=np.int64)
+            left[split] = nodeCount + 2 * np.arange(k)
+            right[split] = left[split] + 1
+            nodeCount += 2 * k
+            levels.append((ids, lo, hi, left, right,
+                           np.where(split, 0, starts), np.where(split, 0, counts), depth))
+
+            if k == 0:
+                break
+
+            # First item with the highest differing bit set, the middle when
+            # every code in the range is the same
+            first = starts[split]
+            last = first + counts[split] - 1
+            differ = codes[first] ^ codes[last]
+            same = differ == 0
+            bit = np.uint64(1) << highestBit(np.where(same, np.uint64(1), differ)).astype(np.uint64)
+            mid = np.searchsorted(codes, (codes[first] | bit) & ~(bit - np.uint64(1))) - first
+            mid[same] = counts[split][same] // 2
+
+            ids = np.column_stack([left[split], right[split]]).ravel()
+            starts = np.column_stack([first, first + mid]).ravel()
+            counts = np.column_stack([mid, counts[split] - mid]).ravel()
+            depth += 1
+
+        self.order = order
+        self.lo = np.zeros((nodeCount, 3))
+        self.hi = np.zeros((nodeCount, 3))
+        self.left = np.zeros(nodeCount, dtype=np.int64)
+        self.right = np.zeros(nodeCount, dtype=np.int64)
+        self.start = np.zeros(nodeCount, dtype=np.int64)
+        self.count = np.zeros(nodeCount, dtype=np.int64)
+        self.depth = np.zeros(nodeCount, dtype=np.int64)
+        for ids, lo, hi, left, right, start, count, depth in levels:
+            self.lo[ids] = lo
+            self.hi[ids] = hi
+            self.left[ids] = left
+            self.right[ids] = right
+            self.start[ids] = start
+            self.count[ids] = count
+            self.depth[ids] = depth
+        self.nodeLists = None
+
+    def leaves(self):
+        return self.count > 0
+
+    def nbytes(self):
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+    def refit(self, itemLo, itemHi):
+        # Same topology, new bounds, bottom up one level at a time
+        self.nodeLists = None
+        itemLo = np.asarray(itemLo)[self.order]
+        itemHi = np.asarray(itemHi)[self.order]
+
+        # Leaves tile the items, sorted by start they line up with reduceat
+        leaves = np.nonzero(self.leaves())[0]
+        leaves = leaves[np.argsort(self.start[leaves])]
+        ranges = self.start[leaves]
+        self.lo[leaves] = np.minimum.reduceat(itemLo, ranges)
+        self.hi[leaves] = np.maximum.reduceat(itemHi, ranges)
+
+        internal = ~self.leaves()
+        for d in range(self.depth.max(), -1, -1):
+            nodes = np.nonzero(internal & (self.depth == d))[0]
+            self.lo[nodes] = np.minimum(self.lo[self.left[nodes]], self.lo[self.right[nodes]])
+            self.hi[nodes] = np.maximum(self.hi[self.left[nodes]], self.hi[self.right[nodes]])
+
+    def expandLeaves(self, nodes):
+        # Item positions (into self.order) of every item in the given leaves,
+        # plus which entry of nodes each one came from
+        counts = self.count[nodes]
+        owner = np.repeat(np.arange(len(nodes)), counts)
+        first = np.cumsum(counts) - counts
+        return self.start[nodes][owner] + np.arange(counts.sum()) - first[owner], owner
+
+    def rayCandidates(self, origins, directions, nearest):
+        # Generator over (ray, leaf) pairs whose boxes the rays enter before
+        # their current nearest hit, nearest may shrink between yields.
+        # Zero direction components get a huge finite inverse instead of
+        # inf, so a ray lying in a slab plane never makes 0 * inf = nan
+        with np.errstate(divide='ignore'):
+            inverse = np.where(np.abs(directions) < 1e-30,
+                               np.copysign(1e30, directions), 1.0 / directions)
+
+        rays = np.arange(len(origins))
+        nodes = np.zeros(len(origins), dtype=np.int64)
+        while len(rays):
+            o = origins[rays]
+            i = inverse[rays]
+            t0 = (self.lo[nodes] - o) * i
+            t1 = (self.hi[nodes] - o) * i
+            near = np.minimum(t0, t1)
+            far = np.maximum(t0, t1)
+            tNear = np.maximum(np.maximum(near[:, 0], near[:, 1]), near[:, 2])
+            tFar = np.minimum(np.minimum(far[:, 0], far[:, 1]), far[:, 2])
+
+            keep = (tFar >= np.maximum(tNear, 0)) & (tNear < nearest[rays])
+            rays, nodes = rays[keep], nodes[keep]
+
+            leaf = self.count[nodes] > 0
+            if leaf.any():
+                yield rays[leaf], nodes[leaf]
+
+            rays, nodes = rays[~leaf], nodes[~leaf]
+            rays = np.concatenate([rays, rays])
+            nodes = np.concatenate([self.left[nodes], self.right[nodes]])
+
+    def lists(self):
+        # The node arrays as Python lists, for single ray traversal
+        if self.nodeLists is None:
+            self.nodeLists = (self.lo.tolist(), self.hi.tolist(), self.left.tolist(),
+                              self.right.tolist(), self.count.tolist())
+        return self.nodeLists
+
+    def nearestHit(self, origin, direction, tMax, hitLeaf):
+        # Walks one ray front to back, hitLeaf(leaf, tMax) returns the
+        # (distance, item) of the nearest hit in a leaf or None. Stops as soon
+        # as every box left starts past the nearest hit.
+        lo, hi, left, right, count = self.lists()
+        origin = [float(v) for v in origin]
+        inverse = [1.0 / float(d) if d != 0 else None for d in direction]
+
+        nearest = None
+        stack = []
+        t = rayEnters(lo[0], hi[0], origin, inverse, tMax)
+        if t is not None:
+            stack.append((t, 0))
+
+        while stack:
+            tEnter, node = stack.pop()
+            if tEnter >= tMax:
+                continue
+
+            if count[node]:
+                hit = hitLeaf(node, tMax)
+                if hit is not None and hit[0] < tMax:
+                    tMax = hit[0]
+                    nearest = hit
+                continue
+
+            tLeft = rayEnters(lo[left[node]], hi[left[node]], origin, inverse, tMax)
+            tRight = rayEnters(lo[right[node]], hi[right[node]], origin, inverse, tMax)
+            children = [(t, child) for t, child in ((tLeft, left[node]), (tRight, right[node])) if t is not None]
+
+            # Nearer child on top
+            children.sort(reverse=True)
+            stack.extend(children)
+        return nearest
+
+
+class MeshBVH(BVH):
+    # BVH over a mesh's triangles in its local space
+
+    def __init__(self, vertices, faces, leafSize=8):
+        triangles = np.asarray(vertices, dtype=np.float64)[np.asarray(faces)]
+        super().__init__(triangles.min(axis=1), triangles.max(axis=1), leafSize)
+        self.triangles = triangles[self.order]
+        self.size = np.linalg.norm(self.hi - self.lo, axis=1)
+
+        # Each triangle's box, placed along with other's node boxes when testing
+        self.triangleLo = self.triangles.min(axis=1)
+        self.triangleHi = self.triangles.max(axis=1)
+
+    def intersectRays(self, origins, directions, tMax=np.inf):
+        # Nearest hit distance and triangle (index into the faces) per ray
+        origins = np.asarray(origins, dtype=np.float64)
+        directions = np.asarray(directions, dtype=np.float64)
+        nearest = np.full(len(origins), tMax, dtype=np.float64)
+        triangle = np.full(len(origins), -1, dtype=np.int64)
+
+        for rays, leaves in self.rayCandidates(origins, directions, nearest):
+            items, owner = self.expandLeaves(leaves)
+            rays = rays[owner]
+            t = rayTriangles(origins[rays], directions[rays], self.triangles[items])
+
+            closer = t < nearest[rays]
+            rays, items, t = rays[closer], items[closer], t[closer]
+            if len(rays) == 0:
+                continue
+
+            # Nearest per ray among this batch
+            first = np.lexsort((t, rays))
+            rays, items, t = rays[first], items[first], t[first]
+            unique = np.r_[True, rays[1:] != rays[:-1]]
+            nearest[rays[unique]] = t[unique]
+            triangle[rays[unique]] = self.order[items[unique]]
+
+        return nearest, triangle
+
+    def intersectRay(self, origin, direction, tMax=np.inf):
+        # (distance, triangle) of the nearest hit of a single ray, or None
+        origin = [float(v) for v in origin]
+        direction = [float(v) for v in direction]
+
+        def hitLeaf(leaf, tMax):
+            first = self.start[leaf]
+            t = rayTrianglesFrom(origin, direction, self.triangles[first:first + self.count[leaf]])
+            i = np.argmin(t)
+            return (float(t[i]), int(self.order[first + i])) if t[i] < tMax else None
+
+        return self.nearestHit(origin, direction, tMax, hitLeaf)
+
+    def contains(self, points, eps=1e-9):
+        # Inside a closed mesh by the parity of a ray's crossings, per point
+        # 1 inside, 0 outside and -1 on the surface, where parity doesn't
+        # say anything
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        inside = np.zeros(len(points), dtype=np.int8)
+        candidates = np.nonzero(np.all((points >= self.lo[0]) & (points <= self.hi[0]), axis=1))[0]
+        if len(candidates) == 0:
+            return inside
+
+        origins = points[candidates]
+        directions = np.broadcast_to(PARITY_DIRECTION, origins.shape)
+        crossings = np.zeros(len(origins), dtype=np.int64)
+        touching = np.zeros(len(origins), dtype=bool)
+
+        # Nothing ever gets nearer than inf, so every hit comes up
+        nearest = np.full(len(origins), np.inf)
+        for rays, leaves in self.rayCandidates(origins, directions, nearest):
+            items, owner = self.expandLeaves(leaves)
+            rays = rays[owner]
+            t = rayTriangles(origins[rays], directions[rays], self.triangles[items])
+            crossings += np.bincount(rays[t < np.inf], minlength=len(origins))
+            touching[rays[t <= eps * self.size[0]]] = True
+
+        inside[candidates] = np.where(touching, -1, crossings % 2)
+        return inside
+
+    def encloses(self, other, transforms, tries=8):
+        # Whether other, placed by each of transforms, sits inside us. Only
+        # holds up once no triangles cross, then any vertex off our surface
+        # decides for the whole part. Spread out vertices are tried in turn
+        # while the earlier ones touch us, all of them touching is contact
+        enclosed = np.zeros(len(transforms), dtype=bool)
+        picks = np.linspace(0, len(other.triangles) - 1, min(tries, len(other.triangles))).astype(np.int64)
+        undecided = np.arange(len(transforms))
+        for vertex in other.triangles[picks, 0]:
+            if len(undecided) == 0:
+                break
+            points = transforms[undecided, :3, :3] @ vertex + transforms[undecided, :3, 3]
+            inside = self.contains(points)
+            enclosed[undecided] = inside == 1
+            undecided = undecided[inside == -1]
+        return enclosed
+
+    def intersectsEach(self, other, transforms, chunk=1 << 16):
+        """
+        For each of transforms placing other in our space, whether the two
+        meshes interfere. Both trees are walked together a level at a time
+        for every placement at once, overlapping leaf pairs are tested as
+        they come up and a placement drops out at its first crossing. The
+        ones left with overlapping root boxes are checked for one part
+        sitting entirely inside the other.
+        """
+        transforms = np.asarray(transforms, dtype=np.float64).reshape(-1, 4, 4)
+        hit = np.zeros(len(transforms), dtype=bool)
+        if len(self.triangles) == 0 or len(other.triangles) == 0:
+            return hit
+
+        rootLo, rootHi = placeBoxes(other.lo[:1], other.hi[:1], transforms)
+        roots = boxesOverlap(self.lo[0], self.hi[0], rootLo, rootHi)
+
+        r = np.nonzero(roots)[0]
+        a = np.zeros(len(r), dtype=np.int64)
+        b = np.zeros(len(r), dtype=np.int64)
+        while len(r):
+            lo, hi = placeBoxes(other.lo[b], other.hi[b], transforms[r])
+            keep = boxesOverlap(self.lo[a], self.hi[a], lo, hi)
+            r, a, b = r[keep], a[keep], b[keep]
+
+            aLeaf = self.count[a] > 0
+            bLeaf = other.count[b] > 0
+            done = aLeaf & bLeaf
+            if done.any():
+                self.testLeaves(other, transforms, r[done], a[done], b[done], hit, chunk)
+
+            # Descend into the bigger of the two, or whichever isn't a leaf,
+            # leaving out placements that already hit
+            splitA = ~aLeaf & (bLeaf | (self.size[a] >= other.size[b]))
+            splitB = ~done & ~splitA
+            r = np.concatenate([r[splitA], r[splitA], r[splitB], r[splitB]])
+            a = np.concatenate([self.left[a[splitA]], self.right[a[splitA]], a[splitB], a[splitB]])
+            b = np.concatenate([b[splitA], b[splitA], other.left[b[splitB]], other.right[b[splitB]]])
+            live = ~hit[r]
+            r, a, b = r[live], a[live], b[live]
+
+        # Nothing crosses, but one part can still be entirely inside the other
+        rest = np.nonzero(roots & ~hit)[0]
+        if len(rest):
+            inside = self.encloses(other, transforms[rest])
+            rest, found = rest[~inside], rest[inside]
+            hit[found] = True
+        if len(rest):
+            hit[rest] = other.encloses(self, np.linalg.inv(transforms[rest]))
+        return hit
+
+    def testLeaves(self, other, transforms, r, a, b, hit, chunk):
+        # Every triangle of leaf a against every triangle of leaf b placed by
+        # transforms[r], marks hit for the placements where any pair crosses
+        countA = self.count[a]
+        countB = other.count[b]
+        pairs = countA * countB
+        ends = np.cumsum(pairs)
+        first = 0
+        while first < len(a):
+            # Whole leaf pairs at a time, up to about chunk triangle pairs
+            last = max(first + 1, int(np.searchsorted(ends, ends[first] - pairs[first] + chunk, 'right')))
+            n = pairs[first:last]
+            owner = np.repeat(np.arange(first, last), n)
+            k = np.arange(n.sum()) - (np.cumsum(n) - n)[owner - first]
+            triA = self.start[a][owner] + k // countB[owner]
+            triB = other.start[b][owner] + k % countB[owner]
+            placement = r[owner]
+
+            # Most triangle pairs of two overlapping leaves don't overlap
+            # themselves, their boxes weed those out cheaply
+            live = ~hit[placement]
+            triA, triB, placement = triA[live], triB[live], placement[live]
+            lo, hi = placeBoxes(other.triangleLo[triB], other.triangleHi[triB], transforms[placement])
+            near = boxesOverlap(self.triangleLo[triA], self.triangleHi[triA], lo, hi)
+            triA, triB, placement = triA[near], triB[near], placement[near]
+
+            tb = np.einsum('nij,nkj->nki', transforms[placement, :3, :3], other.triangles[triB]) + \
+                transforms[placement, None, :3, 3]
+            crossing = trianglesIntersect(self.triangles[triA], tb)
+            hit[placement[crossing]] = True
+            first = last
+
+    def intersects(self, other, transform):
+        return bool(self.intersectsEach(other, transform[None])[0])
+
+
+# One BVH per geometry, built on first use and dropped with the geometry
+meshBVHs = weakref.WeakKeyDictionary()
+
+
+def meshBVH(geometry):
+    bvh = meshBVHs.get(geometry)
+    if bvh is None:
+        bvh = MeshBVH(geometry.vertices(), geometry.faces)
+        meshBVHs[geometry] = bvh
+    return bvh
@@ -0,0 +1,120 @@
+import os
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from bvh import MeshBVH, meshBVHs, boxCorners, boxesOverlap
+
+
+def worldBounds(localLo, localHi, poses):
+    # Boxes of M local boxes under (F, M, 4, 4) poses, every frame at once
+    corners = boxCorners(localLo, localHi)
+    world = np.einsum('fmij,mkj->fmki', poses[..., :3, :3], corners) + poses[..., None, :3, 3]
+    return world.min(axis=2), world.max(axis=2)
+
+
+def broadPhase(lo, hi, frameChunk=64):
+    # (frame, i, j) for every pair of parts whose boxes overlap in a frame
+    i, j = np.triu_indices(lo.shape[1], 1)
+    found = [np.empty((0, 3), dtype=np.int64)]
+    for f0 in range(0, lo.shape[0], frameChunk):
+        l = lo[f0:f0 + frameChunk]
+        h = hi[f0:f0 + frameChunk]
+        frame, pair = np.nonzero(boxesOverlap(l[:, i], h[:, i], l[:, j], h[:, j]))
+        found.append(np.column_stack([frame + f0, i[pair], j[pair]]))
+    return np.concatenate(found)
+
+
+def frameRanges(frames):
+    # Sorted frame numbers to inclusive (first, last) runs
+    breaks = np.nonzero(np.diff(frames) != 1)[0]
+    firsts = np.r_[frames[0], frames[breaks + 1]]
+    lasts = np.r_[frames[breaks], frames[-1]]
+    return [(int(a), int(b)) for a, b in zip(firsts, lasts)]
+
+
+def buildBVH(geometry):
+    return MeshBVH(geometry.vertices(), geometry.faces)
+
+
+workerBVHs = None
+
+
+def initWorker(bvhs):
+    global workerBVHs
+    workerBVHs = bvhs
+
+
+def checkPair(task):
+    a, b, relatives = task
+    return workerBVHs[a].intersectsEach(workerBVHs[b], relatives).tolist()
+
+
+def checkCollisions(geometries, poses, workers=None):
+    """
+    Interference between every pair of parts over a whole animation.
+    geometries is a list of M CompactMesh, poses is (F, M, 4, 4). Returns
+    (i, j, [(first, last), ...]) for every pair that ever intersects.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    bounds = np.array([geometry.bounds() for geometry in geometries])
+    lo, hi = worldBounds(bounds[:, 0], bounds[:, 1], poses)
+    candidates = broadPhase(lo, hi)
+    if len(candidates) == 0:
+        return []
+
+    # Group by pair, within a pair only distinct relative placements are tested
+    candidates = candidates[np.lexsort((candidates[:, 0], candidates[:, 2], candidates[:, 1]))]
+    split = np.nonzero(np.any(np.diff(candidates[:, 1:], axis=0) != 0, axis=1))[0] + 1
+
+    pairs = []
+    for group in np.split(candidates, split):
+        frames, a, b = group[:, 0], group[0, 1], group[0, 2]
+        relative = np.linalg.inv(poses[frames, a]) @ poses[frames, b]
+        keys = np.round(relative.reshape(len(frames), 16), 9)
+        keys, index, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        pairs.append((a, b, frames, relative[index], inverse.reshape(-1)))
+
+    # Triangle BVHs are built once per mesh, in parallel, and kept for next time
+    needed = sorted(set(p[0] for p in pairs) | set(p[1] for p in pairs))
+    missing = [m for m in needed if geometries[m] not in meshBVHs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for m, bvh in zip(missing, pool.map(buildBVH, [geometries[m] for m in missing])):
+            meshBVHs[geometries[m]] = bvh
+
+    bvhs = {m: meshBVHs[geometries[m]] for m in needed}
+    tasks = [(a, b, relatives) for a, b, frames, relatives, inverse in pairs]
+    chunksize = max(1, len(tasks) // (workers * 4))
+
+    collisions = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(bvhs,)) as pool:
+        for (a, b, frames, relatives, inverse), hits in zip(pairs, pool.map(checkPair, tasks, chunksize=chunksize)):
+            colliding = frames[np.asarray(hits)[inverse]]
+            if len(colliding):
+                collisions.append((int(a), int(b), frameRanges(colliding)))
+    return collisions
+
+
+class CollisionChecker(QThread):
+    # Emits a list of (nameA, nameB, [(first, last), ...]) and an error
+    # message, empty unless the check itself failed. Always emits
+    checked = pyqtSignal(list, str)
+
+    def __init__(self, names, geometries, poses, workers=None, parent=None):
+        super().__init__(parent)
+        self.names = names
+        self.geometries = geometries
+        self.poses = poses
+        self.workers = workers
+
+    def run(self):
+        try:
+            collisions = checkCollisions(self.geometries, self.poses, self.workers)
+        except Exception as e:
+            self.checked.emit([], f"{type(e).__name__}: {e}")
+            return
+        self.checked.emit([(self.names[a], self.names[b], ranges) for a, b, ranges in collisions], "")
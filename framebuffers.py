@@ -0,0 +1,263 @@
+import os
+import struct
+import ctypes
+import numpy as np
+import pyrender
+
+import OpenGL.GL as gl
+
+
+# pyrender's fixed sample count, still the default for final frames
+MSAA_SAMPLES = 4
+
+
+def rowStride(width):
+    # Rows of 24 bit pixels padded to 4 bytes, the default GL pack/unpack
+    # alignment and exactly how BMP lays out its rows
+    return (width * 3 + 3) & ~3
+
+
+def bmpHeader(width, height, stride):
+    imageSize = stride * height
+    fileHeader = struct.pack('<2sIHHI', b'BM', 54 + imageSize, 0, 0, 54)
+    # Positive height means the rows are stored bottom-up, same as GL
+    infoHeader = struct.pack(
+        '<IiiHHIIiiII', 40, width, height, 1, 24, 0, imageSize, 2835, 2835, 0, 0)
+    return fileHeader + infoHeader
+
+
+class FramePool():
+    """
+    Preallocated color buffer for the output resolution. Pixels are read back
+    as bottom-up BGR rows, so the same array can go straight to glDrawPixels
+    and straight into a BMP file without flipping or converting.
+    """
+
+    def __init__(self, width=1, height=1):
+        self.width = 0
+        self.height = 0
+        self.tag = None  # Which frame the buffer currently holds
+        self.resize(width, height)
+
+    def resize(self, width, height):
+        if (width, height) == (self.width, self.height):
+            return
+
+        self.width = width
+        self.height = height
+        self.stride = rowStride(width)
+        self.color = np.empty((height, self.stride), dtype=np.uint8)
+        self.header = bmpHeader(width, height, self.stride)
+
+    def pixels(self):
+        # Top-down (h, w, 3) RGB view, no copy
+        rows = self.color[::-1, :self.width * 3]
+        return rows.reshape(self.height, self.width, 3)[:, :, ::-1]
+
+    def read(self):
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 4)
+        gl.glReadPixels(
+            0, 0,
+            self.width, self.height,
+            gl.GL_BGR, gl.GL_UNSIGNED_BYTE,
+            self.color)
+
+    def draw(self):
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+        gl.glDrawPixels(
+            self.width,
+            self.height,
+            gl.GL_BGR,
+            gl.GL_UNSIGNED_BYTE,
+            self.color)
+
+    def saveBmp(self, fileName):
+        # Replaced rather than overwritten, the old file may be a hard link
+        # shared with other frames
+        with open(fileName + '.part', 'wb') as f:
+            f.write(self.header)
+            f.write(self.color)
+        os.replace(fileName + '.part', fileName)
+
+
+class PixelBufferRing():
+    """
+    Asynchronous readback through a ring of pixel buffer objects. Each frame
+    is read into the next PBO without waiting on the GPU, and the oldest PBO,
+    which had count - 1 frames of time to finish, is mapped into the pool.
+    """
+
+    def __init__(self, count=3):
+        self.count = count
+        self.buffers = None
+        self.size = 0
+        self.tags = [None] * count
+        self.next = 0
+
+    def allocate(self, size):
+        if self.buffers is None:
+            self.buffers = gl.glGenBuffers(self.count)
+
+        # Anything still in flight was read at the old size, drop it
+        for buf in self.buffers:
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, buf)
+            gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, size, None, gl.GL_STREAM_READ)
+        self.size = size
+        self.tags = [None] * self.count
+
+    def read(self, pool, tag):
+        size = pool.stride * pool.height
+        if size != self.size:
+            self.allocate(size)
+
+        slot = self.next
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.buffers[slot])
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 4)
+        gl.glReadPixels(
+            0, 0,
+            pool.width, pool.height,
+            gl.GL_BGR, gl.GL_UNSIGNED_BYTE,
+            ctypes.c_void_p(0))
+        self.tags[slot] = tag
+        self.next = (slot + 1) % self.count
+
+        # The slot we write next time round is the oldest one
+        ready = self.map(pool, self.next)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        return ready
+
+    def map(self, pool, slot):
+        tag = self.tags[slot]
+        if tag is None:
+            return None
+
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.buffers[slot])
+        ptr = gl.glMapBufferRange(gl.GL_PIXEL_PACK_BUFFER, 0, self.size, gl.GL_MAP_READ_BIT)
+        ctypes.memmove(pool.color.ctypes.data, ptr, self.size)
+        gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+
+        self.tags[slot] = None
+        return tag
+
+    def drain(self, pool):
+        # Oldest first
+        for i in range(self.count):
+            tag = self.map(pool, (self.next + i) % self.count)
+            if tag is not None:
+                pool.tag = tag
+                yield tag
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+    def delete(self):
+        if self.buffers is not None:
+            gl.glDeleteBuffers(self.count, self.buffers)
+            self.buffers = None
+
+
+class PooledRenderer(pyrender.Renderer):
+    # Reads color into the pool instead of allocating fresh arrays, depth is
+    # only read back when the caller actually asks for it
+
+    def __init__(self, viewport_width, viewport_height, point_size=1.0, pool=None):
+        super().__init__(viewport_width, viewport_height, point_size)
+        self.pool = pool if pool is not None else FramePool()
+        self.readback = None
+        self.tag = None
+        self.samples = MSAA_SAMPLES
+        self.fbSamples = None
+
+    def delete(self):
+        if self.readback is not None:
+            self.readback.delete()
+            self.readback = None
+        super().delete()
+
+    def _configure_main_framebuffer(self):
+        # pyrender's own setup with the sample count left to us, the
+        # multisampled buffers are rebuilt whenever it changes
+        if self._main_fb is not None and (
+                self.fbSamples != self.samples or
+                self._main_fb_dims != (self.viewport_width, self.viewport_height)):
+            self._delete_main_framebuffer()
+        if self._main_fb is not None:
+            return
+
+        width, height = self.viewport_width, self.viewport_height
+
+        def framebuffer(samples):
+            color, depth = gl.glGenRenderbuffers(2)
+            for buffer, format in ((color, gl.GL_RGBA), (depth, gl.GL_DEPTH_COMPONENT24)):
+                gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, buffer)
+                gl.glRenderbufferStorageMultisample(gl.GL_RENDERBUFFER, samples, format, width, height)
+            fb = gl.glGenFramebuffers(1)
+            gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, fb)
+            gl.glFramebufferRenderbuffer(
+                gl.GL_DRAW_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_RENDERBUFFER, color)
+            gl.glFramebufferRenderbuffer(
+                gl.GL_DRAW_FRAMEBUFFER, gl.GL_DEPTH_ATTACHMENT, gl.GL_RENDERBUFFER, depth)
+            return fb, color, depth
+
+        self._main_fb, self._main_cb, self._main_db = framebuffer(0)
+        self._main_fb_ms, self._main_cb_ms, self._main_db_ms = framebuffer(self.samples)
+        self._main_fb_dims = (width, height)
+        self.fbSamples = self.samples
+
+    def _read_main_framebuffer(self, scene, flags):
+        if flags & (pyrender.RenderFlags.DEPTH_ONLY | pyrender.RenderFlags.RGBA):
+            return super()._read_main_framebuffer(scene, flags)
+
+        width, height = self._main_fb_dims[0], self._main_fb_dims[1]
+
+        # Resolve the multisampled color buffer only
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self._main_fb_ms)
+        gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, self._main_fb)
+        gl.glBlitFramebuffer(
+            0, 0, width, height, 0, 0, width, height,
+            gl.GL_COLOR_BUFFER_BIT, gl.GL_LINEAR)
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self._main_fb)
+
+        self.pool.resize(width, height)
+        if self.readback is not None:
+            self.pool.tag = self.readback.read(self.pool, self.tag)
+        else:
+            self.pool.read()
+            self.pool.tag = self.tag
+        return self.pool.color, None
+
+
+class PooledOffscreenRenderer(pyrender.OffscreenRenderer):
+    def __init__(self, viewport_width, viewport_height, point_size=1.0, pool=None):
+        self.pool = pool if pool is not None else FramePool()
+        super().__init__(viewport_width, viewport_height, point_size)
+
+    def _create(self):
+        super()._create()
+        self._renderer = PooledRenderer(
+            self.viewport_width, self.viewport_height, self.point_size, self.pool)
+
+    def render(self, scene, flags=pyrender.RenderFlags.NONE, seg_node_map=None, tag=None):
+        # With asynchronous readback pool.tag says which earlier frame the
+        # pool holds after this returns, None while the ring is filling up
+        self._renderer.tag = tag
+        return super().render(scene, flags, seg_node_map)
+
+    def setSamples(self, samples):
+        # 0 renders single sampled, takes effect with the next frame
+        self._renderer.samples = samples
+
+    def startAsyncReadback(self, buffers=3):
+        self._renderer.readback = PixelBufferRing(buffers)
+
+    def finishAsyncReadback(self):
+        # Maps the frames still in flight into the pool one at a time,
+        # yielding each one's tag, then goes back to synchronous reads
+        readback = self._renderer.readback
+        if readback is None:
+            return
+
+        self._platform.make_current()
+        for tag in readback.drain(self.pool):
+            yield tag
+        readback.delete()
+        self._renderer.readback = None
+
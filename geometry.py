@@ -0,0 +1,226 @@
+import os
+import struct
+import numpy as np
+import trimesh
+import pyrender
+
+
+# Compact mesh file: header, bounding box, uint16 positions, int16 normals, faces
+COMPACT_MAGIC = b'STLAQ16\0'
+COMPACT_HEADER = struct.Struct('<8sQQB3d3d')
+COMPACT_SUFFIX = '.stlq'
+
+POSITION_STEPS = 65535
+NORMAL_STEPS = 32767
+
+# Vertices quantized at a time when building from an indexed mesh file
+CHUNK_VERTICES = 1 << 18
+
+
+def octEncode(normals):
+    # Project onto the octahedron |x| + |y| + |z| = 1, fold the lower half
+    # over the diagonals, then quantize the two remaining coordinates
+    n = normals / np.abs(normals).sum(axis=1, keepdims=True).clip(1e-12)
+    xy = n[:, :2]
+    sign = np.where(xy >= 0, 1.0, -1.0)
+    folded = (1.0 - np.abs(xy[:, ::-1])) * sign
+    xy = np.where(n[:, 2:] < 0, folded, xy)
+    return np.round(xy.clip(-1, 1) * NORMAL_STEPS).astype(np.int16)
+
+
+def octDecode(encoded):
+    xy = encoded.astype(np.float32) / NORMAL_STEPS
+    z = 1.0 - np.abs(xy).sum(axis=1)
+    t = np.clip(-z, 0, None)
+    xy = xy - np.where(xy >= 0, t[:, None], -t[:, None])
+    n = np.column_stack([xy, z])
+    return n / np.linalg.norm(n, axis=1, keepdims=True)
+
+
+class CompactMesh():
+    """
+    Welded, indexed geometry with positions quantized to 16 bits against the
+    part's bounding box and normals packed as octahedral 2x16 bits. This is
+    what a Model keeps around and what gets cached next to the STL. The
+    pyrender mesh made from it still holds float positions and normals for
+    as long as it is in a scene. Baked ambient occlusion, when there is
+    any, is one byte of visibility per vertex.
+    """
+
+    def __init__(self, positions, normals, faces, lo, extent, occlusion=None):
+        self.positions = positions
+        self.normals = normals
+        self.faces = faces
+        self.lo = np.asarray(lo, dtype=np.float64)
+        self.extent = np.asarray(extent, dtype=np.float64)
+        self.occlusion = occlusion
+
+    @classmethod
+    def fromTrimesh(cls, tmesh):
+        vertices = np.asarray(tmesh.vertices, dtype=np.float64)
+        lo = vertices.min(axis=0)
+        extent = vertices.max(axis=0) - lo
+        extent[extent == 0] = 1.0
+
+        positions = np.round((vertices - lo) / extent * POSITION_STEPS).astype(np.uint16)
+        normals = octEncode(np.asarray(tmesh.vertex_normals, dtype=np.float64))
+
+        # Weld again after quantizing, anything that became identical merges
+        packed = np.column_stack([positions.astype(np.int32), normals.astype(np.int32)])
+        packed, index, inverse = np.unique(packed, axis=0, return_index=True, return_inverse=True)
+        faces = inverse.reshape(-1)[np.asarray(tmesh.faces)]
+
+        indexType = np.uint16 if len(index) <= 0xffff else np.uint32
+        return cls(positions[index], normals[index], faces.astype(indexType), lo, extent)
+
+    @classmethod
+    def fromIndexed(cls, vertices, normals, faces, chunk=CHUNK_VERTICES):
+        # From arrays that are already welded, usually mapped from an
+        # indexed mesh file, a chunk at a time so the float data never has
+        # to be in memory whole. Vertices that happen to quantize to the
+        # same values stay separate, there's no global weld
+        lo = np.full(3, np.inf)
+        hi = np.full(3, -np.inf)
+        for start in range(0, len(vertices), chunk):
+            v = vertices[start:start + chunk]
+            lo = np.minimum(lo, v.min(axis=0))
+            hi = np.maximum(hi, v.max(axis=0))
+        extent = hi - lo
+        extent[extent == 0] = 1.0
+
+        positions = np.empty((len(vertices), 3), dtype=np.uint16)
+        encoded = np.empty((len(vertices), 2), dtype=np.int16)
+        for start in range(0, len(vertices), chunk):
+            v = np.asarray(vertices[start:start + chunk], dtype=np.float64)
+            positions[start:start + chunk] = np.round((v - lo) / extent * POSITION_STEPS)
+            encoded[start:start + chunk] = octEncode(
+                np.asarray(normals[start:start + chunk], dtype=np.float64))
+
+        indexType = np.uint16 if len(vertices) <= 0xffff else np.uint32
+        indices = np.empty((len(faces), 3), dtype=indexType)
+        for start in range(0, len(faces), chunk):
+            indices[start:start + chunk] = faces[start:start + chunk]
+        return cls(positions, encoded, indices, lo, extent)
+
+    def vertices(self):
+        return (self.positions * (self.extent / POSITION_STEPS) + self.lo).astype(np.float32)
+
+    def vertexNormals(self):
+        return octDecode(self.normals)
+
+    def bounds(self):
+        return np.array([self.lo, self.lo + self.extent])
+
+    def nbytes(self):
+        total = self.positions.nbytes + self.normals.nbytes + self.faces.nbytes
+        if self.occlusion is not None:
+            total += self.occlusion.nbytes
+        return total
+
+    def visibility(self):
+        # Occlusion as 0..1 floats, None when nothing is baked
+        if self.occlusion is None:
+            return None
+        return self.occlusion.astype(np.float32) / 255.0
+
+    def simplified(self, cells):
+        # Vertex clustering: all vertices in the same cell of a cells^3 grid
+        # over the bounding box merge into their average, faces that
+        # collapse go away
+        cell = self.positions.astype(np.int64) * cells // (POSITION_STEPS + 1)
+        key = (cell[:, 0] * cells + cell[:, 1]) * cells + cell[:, 2]
+        clusters, inverse = np.unique(key, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        count = np.bincount(inverse)[:, None]
+
+        positions = np.column_stack([
+            np.bincount(inverse, self.positions[:, i]) for i in range(3)]) / count
+        vertexNormals = self.vertexNormals()
+        normals = np.column_stack([
+            np.bincount(inverse, vertexNormals[:, i]) for i in range(3)])
+        normals[np.all(normals == 0, axis=1)] = (0, 0, 1)
+
+        occlusion = None
+        if self.occlusion is not None:
+            occlusion = np.round(np.bincount(inverse, self.occlusion) / count[:, 0]).astype(np.uint8)
+
+        faces = inverse[self.faces.astype(np.int64)]
+        faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) &
+                      (faces[:, 2] != faces[:, 0])]
+
+        # Several faces often land on the same three clusters, keep one of
+        # each, comparing rotations so the winding still counts
+        rotation = np.argmin(faces, axis=1)
+        canonical = faces[np.arange(len(faces))[:, None], (rotation[:, None] + np.arange(3)) % 3]
+        _, first = np.unique(canonical, axis=0, return_index=True)
+        faces = faces[np.sort(first)]
+
+        indexType = np.uint16 if len(clusters) <= 0xffff else np.uint32
+        return CompactMesh(
+            np.round(positions).astype(np.uint16), octEncode(normals),
+            faces.astype(indexType), self.lo, self.extent.copy(), occlusion)
+
+    def toTrimesh(self):
+        return trimesh.Trimesh(
+            vertices=self.vertices(),
+            faces=self.faces,
+            vertex_normals=self.vertexNormals(),
+            process=False)
+
+    def toPyrender(self, color):
+        # One colour for the whole part goes in the material, not per vertex.
+        # Baked occlusion is a grey vertex colour, the shader multiplies it in
+        material = pyrender.MetallicRoughnessMaterial(
+            baseColorFactor=color,
+            metallicFactor=0.2,
+            roughnessFactor=0.8)
+        colors = None
+        visibility = self.visibility()
+        if visibility is not None:
+            colors = np.ones((len(visibility), 4), dtype=np.float32)
+            colors[:, :3] = visibility[:, None]
+        primitive = pyrender.Primitive(
+            positions=self.vertices(),
+            normals=self.vertexNormals(),
+            color_0=colors,
+            indices=self.faces,
+            material=material)
+        return pyrender.Mesh(primitives=[primitive])
+
+    def save(self, fileName):
+        with open(fileName, 'wb') as f:
+            f.write(COMPACT_HEADER.pack(
+                COMPACT_MAGIC, len(self.positions), len(self.faces),
+                self.faces.dtype.itemsize, *self.lo, *self.extent))
+            f.write(self.positions.astype('<u2'))
+            f.write(self.normals.astype('<i2'))
+            f.write(self.faces.astype(self.faces.dtype.newbyteorder('<')))
+
+    @classmethod
+    def load(cls, fileName):
+        with open(fileName, 'rb') as f:
+            header = COMPACT_HEADER.unpack(f.read(COMPACT_HEADER.size))
+            magic, vertexCount, faceCount, indexSize = header[:4]
+            if magic != COMPACT_MAGIC:
+                raise ValueError(f"{fileName} is not a compact mesh file")
+
+            positions = np.fromfile(f, dtype='<u2', count=vertexCount * 3).reshape(-1, 3)
+            normals = np.fromfile(f, dtype='<i2', count=vertexCount * 2).reshape(-1, 2)
+            indexType = '<u2' if indexSize == 2 else '<u4'
+            faces = np.fromfile(f, dtype=indexType, count=faceCount * 3).reshape(-1, 3)
+        return cls(positions, normals, faces, header[4:7], header[7:10])
+
+
+def loadCompact(fileName, build):
+    # Cached next to the source, rebuilt with build when the STL is newer
+    cacheName = fileName + COMPACT_SUFFIX
+    if os.path.exists(cacheName) and os.path.getmtime(cacheName) >= os.path.getmtime(fileName):
+        return CompactMesh.load(cacheName)
+
+    geometry = build(fileName)
+    try:
+        geometry.save(cacheName)
+    except OSError:
+        pass
+    return geometry
+
@@ -9,8 +9,6 @@ import matplotlib.pyplot as plt
 import time
 
 from PyQt5 import QtWidgets
-
-from PIL import Image
 from PyQt5.QtWidgets import (
     QApplication,
     QWidget,
@@ -25,15 +23,30 @@ from PyQt5.QtWidgets import (
     QScrollArea,
     QSlider,
     QFileDialog,
-    QColorDialog)
+    QColorDialog,
+    QCheckBox,
+    QMessageBox)
 
-from PyQt5.QtGui import QDoubleValidator
-from PyQt5.QtCore import QTimer, Qt
+from PyQt5.QtGui import QDoubleValidator, QIntValidator, QImage, QPixmap, QPalette
+from PyQt5.QtCore import QTimer, Qt, QThread
 from PyQt5.QtCore import pyqtSlot
 
 from stl import mesh
 from enum import Enum
 from qtimeline import *
+from assembly import AssemblyImporter, loadGeometry
+from staticbatch import StaticBatch
+from viewport import AdaptiveResolution
+from framebuffers import FramePool, PooledOffscreenRenderer, MSAA_SAMPLES
+from thumbnails import ThumbnailCache, ThumbnailWorker
+from collision import CollisionChecker
+from occlusion import OcclusionBaker
+from scenefile import snapshotScene, sceneState
+from renderqueue import DEFAULT_PORT, linkFrame
+from renderclient import submitJob, RenderMonitor
+from picking import Picker, cameraRay
+from memory import MemoryManager, MEGABYTE
+from preview import DraftPreview
 
 import OpenGL.GL as gl
 import OpenGL.GLU as glu
@@ -142,6 +155,7 @@ def defaultCameraPose():
 class ProgramStates(Enum):
     POSITIONING = 1
     RENDERING = 2
+    PREVIEW = 3
 
 
 class StartStopButton(QPushButton):
@@ -169,6 +183,14 @@ class App(QWidget):
         self.currentFrame = 0
         self.numberOfFrames = 100
 
+        self.thumbnails = ThumbnailCache()
+        self.thumbnailWorker = None
+        self.thumbnailStride = 10
+
+        self.renderMonitor = None
+
+        self.selectedModel = None
+
     def mousePressEvent(self, event):
         self.glWidget.mousePressEvent(event)
 
@@ -189,7 +211,6 @@ class App(QWidget):
 
         self.models = {}
         self.models_ui = {}
-        self.meshes = {}
 
         self.setGeometry(self.left, self.top, self.width, self.height)
 
@@ -213,11 +234,19 @@ class App(QWidget):
                 self.loadModelBtn = QPushButton('Load STL file')
                 self.loadModelBtn.clicked.connect(self.loadModel)
 
+                self.importAssemblyBtn = QPushButton('Import Assembly')
+                self.importAssemblyBtn.clicked.connect(self.importAssembly)
+
                 self.renderAnimationBtn = QPushButton('Render Animation')
                 self.renderAnimationBtn.clicked.connect(self.renderAnimation)
 
+                self.previewAnimationBtn = QPushButton('Draft Preview')
+                self.previewAnimationBtn.clicked.connect(self.previewAnimation)
+
                 self.sidePanel.addWidget(self.loadModelBtn)
+                self.sidePanel.addWidget(self.importAssemblyBtn)
                 self.sidePanel.addWidget(self.renderAnimationBtn)
+                self.sidePanel.addWidget(self.previewAnimationBtn)
                 self.sidePanel.addStretch(1)
 
                 self.sidePanelScroll = QScrollArea()
@@ -251,8 +280,77 @@ class App(QWidget):
                 changeBg.clicked.connect(changeBgEvent)
 
                 form.addRow("Background Color", changeBg)
-                # TODO(Dustin): Validate
-                form.addRow("Framerate", QLineEdit())
+                self.framerateEdit = QLineEdit()
+                self.framerateEdit.setText(str(30))
+                self.framerateEdit.setValidator(QIntValidator(1, 240))
+                form.addRow("Framerate", self.framerateEdit)
+
+                # Off plays every frame, slower than real time if need be
+                self.previewSkipCheck = QCheckBox("Skip frames to keep time")
+                self.previewSkipCheck.setChecked(True)
+                form.addRow("Draft Preview", self.previewSkipCheck)
+
+                self.thumbnailStrideEdit = QLineEdit()
+                self.thumbnailStrideEdit.setText(str(10))
+                self.thumbnailStrideEdit.setValidator(QIntValidator(1, 400))
+                form.addRow("Thumbnail Stride", self.thumbnailStrideEdit)
+
+                generateThumbnails = QPushButton("Generate")
+                generateThumbnails.clicked.connect(self.generateThumbnails)
+                form.addRow("Thumbnails", generateThumbnails)
+
+                self.checkCollisionsBtn = QPushButton("Check")
+                self.checkCollisionsBtn.clicked.connect(self.checkCollisions)
+                form.addRow("Collisions", self.checkCollisionsBtn)
+
+                self.collisionsLabel = QLabel("")
+                self.collisionsLabel.setWordWrap(True)
+                form.addRow("", self.collisionsLabel)
+
+                self.bakeOcclusionBtn = QPushButton("Bake")
+                self.bakeOcclusionBtn.clicked.connect(self.bakeOcclusion)
+                form.addRow("Ambient Occlusion", self.bakeOcclusionBtn)
+
+                self.occlusionLabel = QLabel("")
+                form.addRow("", self.occlusionLabel)
+
+                self.renderServerEdit = QLineEdit()
+                self.renderServerEdit.setText(f"http://localhost:{DEFAULT_PORT}")
+                form.addRow("Render Server", self.renderServerEdit)
+
+                self.renderPriorityEdit = QLineEdit()
+                self.renderPriorityEdit.setText(str(0))
+                self.renderPriorityEdit.setValidator(QIntValidator(-100, 100))
+                form.addRow("Priority", self.renderPriorityEdit)
+
+                submitRender = QPushButton("Submit")
+                submitRender.clicked.connect(self.submitRender)
+                form.addRow("Render Job", submitRender)
+
+                self.renderJobLabel = QLabel("")
+                self.renderJobLabel.setWordWrap(True)
+                form.addRow("", self.renderJobLabel)
+
+                def budgetChanged():
+                    memory = self.glWidget.memory
+                    memory.hostBudget = int(self.hostBudgetEdit.text() or 0) * MEGABYTE
+                    memory.gpuBudget = int(self.gpuBudgetEdit.text() or 0) * MEGABYTE
+
+                self.hostBudgetEdit = QLineEdit()
+                self.hostBudgetEdit.setText(str(self.glWidget.memory.hostBudget // MEGABYTE))
+                self.hostBudgetEdit.setValidator(QIntValidator(0, 1 << 20))
+                self.hostBudgetEdit.editingFinished.connect(budgetChanged)
+                form.addRow("Host Budget (MB)", self.hostBudgetEdit)
+
+                self.gpuBudgetEdit = QLineEdit()
+                self.gpuBudgetEdit.setText(str(self.glWidget.memory.gpuBudget // MEGABYTE))
+                self.gpuBudgetEdit.setValidator(QIntValidator(0, 1 << 20))
+                self.gpuBudgetEdit.editingFinished.connect(budgetChanged)
+                form.addRow("GPU Budget (MB)", self.gpuBudgetEdit)
+
+                self.memoryLabel = QLabel("")
+                self.memoryLabel.setWordWrap(True)
+                form.addRow("Memory", self.memoryLabel)
                 self.animationSettingsPanel.addLayout(form)
 
 
@@ -317,145 +415,374 @@ class App(QWidget):
 
     @pyqtSlot()
     def renderAnimation(self):
+        if self.programState == ProgramStates.PREVIEW:
+            self.stopPreview()
+
         self.frameSlider.setValue(0)
+        os.makedirs('./tmp_frames', exist_ok=True)
         self.programState = ProgramStates.RENDERING
         self.currentFrame = 0
+        self.glWidget.memory.restore(self.models, self.glWidget.staticBatch)
+        self.glWidget.startCapture()
 
     @pyqtSlot()
-    def loadModel(self):
-        options = QFileDialog.Options()
-        options |= QFileDialog.DontUseNativeDialog
-        fileName, _ = QFileDialog.getOpenFileName(
-            self,
-            "QFileDialog.getOpenFileName()",
-            "",
-            "All Files (*);;STL Files (*.stl)",
-            options=options)
-
-        if fileName:
-            print(f"Loading STL model: {fileName}")
-
-            tmesh = trimesh.load(fileName)
-
-            # Fix normals
-            trimesh.repair.fix_winding(tmesh)
-            trimesh.repair.fix_normals(tmesh)
-            trimesh.repair.fill_holes(tmesh)
-
-            mesh = pyrender.Mesh.from_trimesh(tmesh)
-            node = pyrender.Node(mesh=mesh, matrix=np.eye(4))
-
-            fileName = fileName + str(len(self.models))
-
-            self.meshes[fileName] = mesh
-
-            # Add mesh to the scene
-            self.glWidget.scene.add_node(node)
-
-            model = Model(tmesh, mesh, node, self)
-
-            model.scale = (0.001, 0.001, 0.001)
-            model.color = (
-                0.5 + (random.random() * 0.08),
-                0.5 + (random.random() * 0.08),
-                0.5 + (random.random() * 0.08),
-                1.0)
-            self.models[fileName] = model
-
-            # model.setKeyFrame(self.frameSlider.value())
-
-            # Create the ui to edit the models properties
-            flo = QFormLayout()
-
-            translation = QHBoxLayout()
-            rotation = QHBoxLayout()
+    def previewAnimation(self):
+        if self.programState == ProgramStates.PREVIEW:
+            self.stopPreview()
+            return
+        if self.programState != ProgramStates.POSITIONING:
+            return
 
-            translationX = QLineEdit()
-            translationX.setText(str(model.translation[0]))
-            translationX.setValidator(QDoubleValidator(-99, 99, 2))
-            translation.addWidget(translationX)
+        self.glWidget.startPreview(
+            self.numberOfFrames, int(self.framerateEdit.text() or 30), self.previewSkipCheck.isChecked())
+        self.programState = ProgramStates.PREVIEW
+        self.previewAnimationBtn.setText('Stop Preview')
 
-            translationY = QLineEdit()
-            translationY.setText(str(model.translation[1]))
-            translationY.setValidator(QDoubleValidator(-99, 99, 2))
-            translation.addWidget(translationY)
+    def stopPreview(self):
+        shown = self.glWidget.stopPreview()
+        print(f"Preview showed {shown} of {self.numberOfFrames} frames")
+        self.programState = ProgramStates.POSITIONING
+        self.previewAnimationBtn.setText('Draft Preview')
 
-            translationZ = QLineEdit()
-            translationZ.setText(str(model.translation[2]))
-            translationZ.setValidator(QDoubleValidator(-99, 99, 2))
-            translation.addWidget(translationZ)
+    @pyqtSlot()
+    def submitRender(self):
+        # Hands the animation to the render service instead of rendering here
+        server = self.renderServerEdit.text()
+        scene = snapshotScene(self.glWidget, self.models, self.numberOfFrames)
+        try:
+            jobId = submitJob(server, scene, int(self.renderPriorityEdit.text() or 0))
+        except (OSError, RuntimeError) as e:
+            self.renderJobLabel.setText(f"Couldn't submit: {e}")
+            return
 
-            rotationX = QLineEdit()
-            rotationX.setText(str(model.rotation[0]))
-            rotationX.setValidator(QDoubleValidator(-360, 360, 2))
-            rotation.addWidget(rotationX)
+        print(f"Submitted render job {jobId} to {server}")
+        self.frameSlider.setProgress([])
+        if self.renderMonitor is not None:
+            self.renderMonitor.requestInterruption()
+        self.renderMonitor = RenderMonitor(server, jobId, parent=self)
+        self.renderMonitor.progress.connect(self.renderProgress)
+        self.renderMonitor.start()
+
+    @pyqtSlot(dict)
+    def renderProgress(self, status):
+        done = sum(last - first + 1 for first, last in status['rendered'])
+        self.renderJobLabel.setText(
+            f"Job {status['id']} {status['state']}: {done}/{status['frames']} frames in {status['output']}")
+        self.frameSlider.setProgress(status['rendered'])
+        if status['state'] == 'failed':
+            print("\n".join(status['errors']))
 
-            rotationY = QLineEdit()
-            rotationY.setText(str(model.rotation[1]))
-            rotationY.setValidator(QDoubleValidator(-360, 360, 2))
-            rotation.addWidget(rotationY)
+    @pyqtSlot()
+    def generateThumbnails(self):
+        # The old worker stops after its current frame and cleans up after
+        # itself, the GUI thread never waits for it
+        if self.thumbnailWorker is not None:
+            self.thumbnailWorker.requestInterruption()
+
+        self.thumbnailStride = int(self.thumbnailStrideEdit.text() or 10)
+        frames = range(0, self.numberOfFrames, self.thumbnailStride)
+
+        # One track sample per thumbnail, pictures get filled in as they arrive
+        scale = self.frameSlider.getScale()
+        self.frameSlider.setSamples([VideoSample(self.thumbnailStride * scale) for frame in frames])
+
+        self.thumbnailWorker = ThumbnailWorker(self.glWidget, self.models, frames, self.thumbnails, parent=self)
+        self.thumbnailWorker.ready.connect(self.thumbnailReady)
+        self.thumbnailWorker.finished.connect(self.thumbnailWorker.deleteLater)
+        self.thumbnailWorker.start(QThread.LowestPriority)
+
+    @pyqtSlot(int, QImage)
+    def thumbnailReady(self, frame, image):
+        # Queued signals from a worker that was already replaced can still
+        # arrive, and the track may have been rebuilt since
+        if self.sender() is not self.thumbnailWorker:
+            return
+        index = frame // self.thumbnailStride
+        if index >= len(self.frameSlider.videoSamples):
+            return
+        sample = self.frameSlider.videoSamples[index]
+        sample.picture = QPixmap.fromImage(image).scaledToHeight(45)
+        self.frameSlider.redrawSample(sample)
 
-            rotationZ = QLineEdit()
-            rotationZ.setText(str(model.rotation[2]))
-            rotationZ.setValidator(QDoubleValidator(-360, 360, 2))
-            rotation.addWidget(rotationZ)
+    @pyqtSlot()
+    def checkCollisions(self):
+        names = [name for name, model in self.models.items() if model.showing]
+        if len(names) < 2:
+            self.collisionsLabel.setText("Nothing to check")
+            return
 
-            start = QPushButton('New Keyframe')
-            hide = QPushButton('Hide')
+        # Every visible part's pose at every frame, checked in a process pool
+        frames = np.arange(self.numberOfFrames)
+        geometries = [self.models[name].geometry for name in names]
+        poses = np.stack([self.models[name].posesAt(frames) for name in names], axis=1)
+
+        self.checkCollisionsBtn.setEnabled(False)
+        self.collisionsLabel.setText("Checking...")
+        self.collisionChecker = CollisionChecker(names, geometries, poses, parent=self)
+        self.collisionChecker.checked.connect(self.collisionsChecked)
+        self.collisionChecker.start()
+
+    @pyqtSlot(list, str)
+    def collisionsChecked(self, collisions, error):
+        self.checkCollisionsBtn.setEnabled(True)
+        if error:
+            print(f"Collision check failed: {error}")
+            self.collisionsLabel.setText(f"Check failed: {error}")
+            return
 
-            @pyqtSlot()
-            def changeColorDialog():
-                color = QColorDialog.getColor()
-                if color.isValid():
-                    r, g, b, _ = color.getRgb()
-                    model.color = (r, g, b)
+        ranges = []
+        lines = []
+        for nameA, nameB, pairRanges in collisions:
+            ranges.extend(pairRanges)
+            spans = ", ".join(f"{a}-{b}" if a != b else f"{a}" for a, b in pairRanges)
+            lines.append(f"{os.path.basename(nameA)} / {os.path.basename(nameB)}: {spans}")
+            print(f"Collision {nameA} / {nameB} at frames {spans}")
 
-            @pyqtSlot()
-            def clickedStart():
-                model.setKeyFrame(self.frameSlider.pointerPos)
+        self.collisionsLabel.setText("\n".join(lines) or "No collisions")
+        self.frameSlider.setRanges(ranges)
 
-            @pyqtSlot()
-            def clickedHide():
-                model.showing = not model.showing
-                if hide.text() == 'Hide':
-                    hide.setText('Show')
-                else:
-                    hide.setText('Hide')
+    @pyqtSlot()
+    def bakeOcclusion(self):
+        # Once per distinct mesh, parts that share geometry share the bake
+        sources = []
+        geometries = []
+        for mod in self.models.values():
+            geometry = mod.geometry
+            if geometry.occlusion is None and all(g is not geometry for g in geometries):
+                sources.append(mod.source)
+                geometries.append(geometry)
+        if not geometries:
+            self.occlusionLabel.setText("Nothing to bake")
+            return
 
-            changeColor = QPushButton("Change Color")
-            changeColor.clicked.connect(changeColorDialog)
+        self.bakeOcclusionBtn.setEnabled(False)
+        self.occlusionLabel.setText(f"Baking {len(geometries)} meshes...")
+        self.occlusionBaker = OcclusionBaker(sources, geometries, parent=self)
+        self.occlusionBaker.baked.connect(self.occlusionBaked)
+        self.occlusionBaker.start()
+
+    @pyqtSlot(list, str)
+    def occlusionBaked(self, visibility, error):
+        self.bakeOcclusionBtn.setEnabled(True)
+        if error:
+            print(f"Occlusion bake failed: {error}")
+            self.occlusionLabel.setText(f"Bake failed: {error}")
+            return
 
-            start.clicked.connect(clickedStart)
-            hide.clicked.connect(clickedHide)
+        geometries = self.occlusionBaker.geometries
+        for geometry, v in zip(geometries, visibility):
+            geometry.occlusion = v
 
-            self.models_ui[fileName] = {
-                'X': translationX,
-                'Y': translationY,
-                'Z': translationZ,
-                'RX': rotationX,
-                'RY': rotationY,
-                'RZ': rotationZ,
-                'animToggle': start,
-                'State': 'Start'}
+        # Meshes carry the occlusion as vertex colours, so the ones already
+        # built are rebuilt, batched parts come back out of the batch for it
+        for name, mod in self.models.items():
+            if mod.node is None or all(g is not mod.loadedGeometry for g in geometries):
+                continue
+            drawn = self.glWidget.scene.has_node(mod.node) or self.glWidget.staticBatch.holds(name, mod)
+            mod.dropMesh()
+            if drawn:
+                self.glWidget.memory.show(mod)
 
-            flo.addRow("Model: ", QLabel(os.path.basename(fileName)))
-            flo.addRow("Translation", translation)
-            flo.addRow("Rotation", rotation)
-            flo.addRow("", changeColor)
+        self.occlusionLabel.setText(f"Baked {len(geometries)} meshes")
 
-            buttons = QHBoxLayout()
-            buttons.addWidget(start)
-            buttons.addWidget(hide)
+    @pyqtSlot()
+    def loadModel(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fileName, _ = QFileDialog.getOpenFileName(
+            self,
+            "QFileDialog.getOpenFileName()",
+            "",
+            "All Files (*);;STL Files (*.stl)",
+            options=options)
 
-            flo.addRow("Controls", buttons)
+        if fileName:
+            print(f"Loading STL model: {fileName}")
+            geometry = loadGeometry(fileName)
+            self.createModel(fileName, geometry)
+            self.glWidget.picker.warm([geometry])
 
-            widget = QWidget()
-            widget.setLayout(flo)
+    @pyqtSlot()
+    def importAssembly(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        folder = QFileDialog.getExistingDirectory(
+            self,
+            "Import Assembly",
+            "",
+            options=options)
 
-            self.sidePanel.addWidget(widget)
+        if folder:
+            print(f"Importing assembly: {folder}")
+            self.importAssemblyBtn.setEnabled(False)
+
+            # Repair runs in a process pool off the UI thread
+            self.assemblyImporter = AssemblyImporter(folder, parent=self)
+            self.assemblyImporter.loaded.connect(self.assemblyLoaded)
+            self.assemblyImporter.start()
+
+    @pyqtSlot(list, list)
+    def assemblyLoaded(self, parts, failures):
+        self.importAssemblyBtn.setEnabled(True)
+        print(f"Adding {len(parts)} parts to the scene")
+
+        if failures:
+            for fileName, error in failures:
+                print(f"Skipped {fileName}: {error}")
+            lines = [f"{os.path.basename(fileName)}: {error}" for fileName, error in failures[:20]]
+            if len(failures) > 20:
+                lines.append(f"... and {len(failures) - 20} more")
+            QMessageBox.warning(
+                self, "Import Assembly",
+                f"Skipped {len(failures)} of {len(parts) + len(failures)} files:\n\n" + "\n".join(lines))
+
+        # Merge every part at once so the side panel only lays out once
+        self.sidePanelWidget.setUpdatesEnabled(False)
+        for fileName, geometry, placement in parts:
+            self.createModel(fileName, geometry, placement)
+        self.sidePanelWidget.setUpdatesEnabled(True)
+
+        self.glWidget.picker.warm([geometry for fileName, geometry, placement in parts])
+
+    def selectModel(self, name):
+        # Highlights the model's entry in the side panel and scrolls to it,
+        # None clears the selection
+        if self.selectedModel in self.models_ui:
+            self.models_ui[self.selectedModel]['Widget'].setAutoFillBackground(False)
+
+        self.selectedModel = name
+        if name is None:
+            return
 
-    def createModel(self, stl_file):
-        pass
+        widget = self.models_ui[name]['Widget']
+        widget.setBackgroundRole(QPalette.Midlight)
+        widget.setAutoFillBackground(True)
+        self.sidePanelTabs.setCurrentWidget(self.sidePanelScroll)
+        self.sidePanelScroll.ensureWidgetVisible(widget)
+        print(f"Selected {name}")
+
+    def updateKeyframeMarkers(self):
+        frames = set()
+        for model in self.models.values():
+            frames.update(model.keyedFrames)
+        self.frameSlider.setMarkers(frames)
+
+    def createModel(self, fileName, geometry, placement=None):
+        source = fileName
+        fileName = fileName + str(len(self.models))
+
+        model = Model(geometry, self, source)
+
+        model.scale = (0.001, 0.001, 0.001)
+        if placement is not None:
+            model.translation, model.rotation = placement
+        model.color = (
+            0.5 + (random.random() * 0.08),
+            0.5 + (random.random() * 0.08),
+            0.5 + (random.random() * 0.08),
+            1.0)
+        self.models[fileName] = model
+
+        # model.setKeyFrame(self.frameSlider.value())
+
+        # Create the ui to edit the models properties
+        flo = QFormLayout()
+
+        translation = QHBoxLayout()
+        rotation = QHBoxLayout()
+
+        translationX = QLineEdit()
+        translationX.setText(str(model.translation[0]))
+        translationX.setValidator(QDoubleValidator(-99, 99, 2))
+        translation.addWidget(translationX)
+
+        translationY = QLineEdit()
+        translationY.setText(str(model.translation[1]))
+        translationY.setValidator(QDoubleValidator(-99, 99, 2))
+        translation.addWidget(translationY)
+
+        translationZ = QLineEdit()
+        translationZ.setText(str(model.translation[2]))
+        translationZ.setValidator(QDoubleValidator(-99, 99, 2))
+        translation.addWidget(translationZ)
+
+        rotationX = QLineEdit()
+        rotationX.setText(str(model.rotation[0]))
+        rotationX.setValidator(QDoubleValidator(-360, 360, 2))
+        rotation.addWidget(rotationX)
+
+        rotationY = QLineEdit()
+        rotationY.setText(str(model.rotation[1]))
+        rotationY.setValidator(QDoubleValidator(-360, 360, 2))
+        rotation.addWidget(rotationY)
+
+        rotationZ = QLineEdit()
+        rotationZ.setText(str(model.rotation[2]))
+        rotationZ.setValidator(QDoubleValidator(-360, 360, 2))
+        rotation.addWidget(rotationZ)
+
+        start = QPushButton('New Keyframe')
+        hide = QPushButton('Hide')
+
+        @pyqtSlot()
+        def changeColorDialog():
+            color = QColorDialog.getColor()
+            if color.isValid():
+                r, g, b, _ = color.getRgbF()
+                model.color = (r, g, b)
+
+        @pyqtSlot()
+        def clickedStart():
+            model.setKeyFrame(self.frameSlider.pointerPos)
+            self.updateKeyframeMarkers()
+
+        @pyqtSlot()
+        def clickedHide():
+            model.showing = not model.showing
+
+            # Off the draw list right away, back on (reloading if need be)
+            if model.showing:
+                self.glWidget.memory.show(model)
+            else:
+                self.glWidget.memory.hide(model)
+
+            if hide.text() == 'Hide':
+                hide.setText('Show')
+            else:
+                hide.setText('Hide')
+
+        changeColor = QPushButton("Change Color")
+        changeColor.clicked.connect(changeColorDialog)
+
+        start.clicked.connect(clickedStart)
+        hide.clicked.connect(clickedHide)
+
+        self.models_ui[fileName] = {
+            'X': translationX,
+            'Y': translationY,
+            'Z': translationZ,
+            'RX': rotationX,
+            'RY': rotationY,
+            'RZ': rotationZ,
+            'animToggle': start,
+            'State': 'Start'}
+
+        flo.addRow("Model: ", QLabel(os.path.basename(fileName)))
+        flo.addRow("Translation", translation)
+        flo.addRow("Rotation", rotation)
+        flo.addRow("", changeColor)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(start)
+        buttons.addWidget(hide)
+
+        flo.addRow("Controls", buttons)
+
+        widget = QWidget()
+        widget.setLayout(flo)
+        self.models_ui[fileName]['Widget'] = widget
+
+        self.sidePanel.addWidget(widget)
 
 
 class GLWidget(QOpenGLWidget):
@@ -479,6 +806,7 @@ class GLWidget(QOpenGLWidget):
         self.dist = 12
         self.angle = 0.0
         self.lastpos = (-1, -1)
+        self.pressPos = None
         self.mouseWithin = False
 
         self.scene = pyrender.Scene(
@@ -512,8 +840,71 @@ class GLWidget(QOpenGLWidget):
         self.scene.add(self.side_light_1, pose=np.array(translate((2,1,1))))
         self.scene.add(self.side_light_2, pose=np.array(translate((-1,1,-2))))
 
-        self.offscreenRenderer = pyrender.OffscreenRenderer(self.width, self.height)
-        self.color, depth = self.offscreenRenderer.render(self.scene)
+        self.staticBatch = StaticBatch(self.scene)
+
+        self.picker = Picker()
+
+        self.memory = MemoryManager(self.scene)
+
+        self.resolution = AdaptiveResolution()
+
+        # PBOs in flight while capturing, 0 reads every frame synchronously
+        self.captureBuffers = 3
+
+        # Last frame actually rendered while capturing, and the frames that
+        # repeat it
+        self.renderedState = None
+        self.renderedFrame = None
+        self.savedFrame = None
+        self.heldFrames = {}
+
+        # Draft preview renders stand-in meshes at this fraction of the
+        # widget size, single sampled and unlit
+        self.previewScale = 0.5
+        self.preview = DraftPreview()
+        self.previewStart = 0.0
+        self.previewFps = 30
+        self.previewSkip = True
+        self.previewFrame = -1
+        self.previewShown = 0
+
+        # Every frame is read back into the same preallocated buffer
+        self.frames = FramePool(self.width, self.height)
+        self.offscreenRenderer = PooledOffscreenRenderer(self.width, self.height, pool=self.frames)
+        self.offscreenRenderer.render(self.scene)
+
+    def startCapture(self):
+        self.renderedState = None
+        self.renderedFrame = None
+        self.savedFrame = None
+        self.heldFrames = {}
+        if self.captureBuffers:
+            self.offscreenRenderer.startAsyncReadback(self.captureBuffers)
+
+    def startPreview(self, frames, fps, skip=True):
+        self.preview.build(self.scene, self.models, frames)
+        self.offscreenRenderer.setSamples(0)
+        self.previewStart = time.time()
+        self.previewFps = fps
+        self.previewSkip = skip
+        self.previewFrame = -1
+        self.previewShown = 0
+
+    def stopPreview(self):
+        # How many frames actually made it to the screen
+        self.preview.clear()
+        self.offscreenRenderer.setSamples(MSAA_SAMPLES)
+        return self.previewShown
+
+    def saveFrame(self, frame):
+        # The pool is already in BMP row order
+        fileName = f"./tmp_frames/{frame}.bmp"
+        self.frames.saveBmp(fileName)
+        self.savedFrame = frame
+
+        # Frames where nothing changed share the image
+        for held in self.heldFrames.pop(frame, []):
+            linkFrame(fileName, f"./tmp_frames/{held}.bmp")
 
     def enterEvent(self, event):
         self.mouseWithin = True
@@ -527,6 +918,7 @@ class GLWidget(QOpenGLWidget):
     def wheelEvent(self, event):
         if not self.mouseWithin:
             return
+        self.resolution.interact()
         if event.angleDelta().y() > 0:
             self.dist *= 0.9
         else:
@@ -540,9 +932,34 @@ class GLWidget(QOpenGLWidget):
             return
         if event.button() == 1:
             self.lastpos = (event.pos().x(), event.pos().y())
+            self.pressPos = self.lastpos
 
     def mouseReleaseEvent(self, event):
-        pass
+        if not self.mouseWithin or event.button() != 1 or self.pressPos is None:
+            return
+
+        # A click rather than the end of an orbit
+        x, y = event.pos().x(), event.pos().y()
+        if abs(x - self.pressPos[0]) + abs(y - self.pressPos[1]) <= 3:
+            self.pick(x, y)
+        self.pressPos = None
+
+    def pick(self, x, y):
+        if self.app.programState != ProgramStates.POSITIONING:
+            return
+
+        self.picker.update(self.models)
+
+        # Same camera paintGL set up with lookat
+        cameraNode = self.scene.main_camera_node
+        camera = cameraNode.camera
+        aspectRatio = camera.aspectRatio or self.width / self.height
+        origin, direction = cameraRay(
+            self.scene.get_pose(cameraNode), camera.yfov, aspectRatio,
+            x, y, self.width, self.height)
+
+        hit = self.picker.pick(origin, direction)
+        self.app.selectModel(hit[0] if hit is not None else None)
 
     def mouseMoveEvent(self, event):
         if not self.mouseWithin:
@@ -551,6 +968,7 @@ class GLWidget(QOpenGLWidget):
             self.lastpos = (event.pos().x(), event.pos().y())
 
         if event.button() == 0:
+            self.resolution.interact()
             self.angle += (event.pos().x() - self.lastpos[0]) * 0.01
             self.lastpos = (event.pos().x(), event.pos().y())
 
@@ -641,98 +1059,128 @@ class GLWidget(QOpenGLWidget):
                 except ValueError:
                     pass
 
+                # Baked into the static batch, or evicted, nothing to update
+                if self.staticBatch.holds(modName, mod) or not self.scene.has_node(mod.node):
+                    continue
+
                 # Update the models position
-                trans = (
-                    mod.translation[0] / 100.0,
-                    mod.translation[1] / 100.0,
-                    mod.translation[2] / 100.0)
+                self.scene.set_pose(mod.node, pose=mod.poseMatrix())
+
+            self.staticBatch.update(self.models, self.models_ui)
+
+            cameraNode = self.scene.main_camera_node
+            viewProjection = (cameraNode.camera.get_projection_matrix(self.width, self.height) @
+                              np.linalg.inv(self.scene.get_pose(cameraNode)))
+            if self.memory.update(self.models, self.staticBatch, viewProjection):
+                self.app.memoryLabel.setText(self.memory.usage())
 
-                modelView = translate(trans)
-                modelView = modelView * rotx(mod.rotation[0] + 90.0)
-                modelView = modelView * roty(mod.rotation[1])
-                modelView = modelView * rotz(mod.rotation[2] + 180)
-                modelView = modelView * scale(mod.scale)
+            # Upscale whatever resolution the last frame was rendered at
+            gl.glPixelZoom(self.width / self.frames.width, self.height / self.frames.height)
+            self.frames.draw()
+            gl.glPixelZoom(1, 1)
 
-                self.scene.set_pose(mod.node, pose=np.array(modelView))
+            width, height = self.resolution.renderSize(self.width, self.height)
+            self.offscreenRenderer.viewport_width = width
+            self.offscreenRenderer.viewport_height = height
 
             start = time.time()
+            self.offscreenRenderer.render(self.scene)
+            self.resolution.frameRendered(time.time() - start)
+
+        elif self.app.programState == ProgramStates.PREVIEW:
+            # Wall clock decides the frame, frames we were too slow for are
+            # skipped rather than slowing the playback down. Without
+            # skipping it never gets ahead of the clock, but can fall behind
+            frame = int((time.time() - self.previewStart) * self.previewFps)
+            if not self.previewSkip:
+                frame = min(frame, self.previewFrame + 1)
+            if frame >= self.app.numberOfFrames:
+                self.app.stopPreview()
+                return
+
+            if frame != self.previewFrame:
+                self.preview.update(self.scene.get_pose(self.scene.main_camera_node), frame)
 
-            gl.glDrawPixels(
-                self.width,
-                self.height,
-                gl.GL_RGB,
-                gl.GL_UNSIGNED_BYTE,
-                np.flipud(self.color))
+                self.offscreenRenderer.viewport_width = max(1, int(self.width * self.previewScale))
+                self.offscreenRenderer.viewport_height = max(1, int(self.height * self.previewScale))
+                self.offscreenRenderer.render(self.preview.scene, flags=pyrender.RenderFlags.FLAT)
 
-            self.color, depth = self.offscreenRenderer.render(self.scene)
+                self.previewFrame = frame
+                self.previewShown += 1
+                self.app.frameSlider.setValue(frame)
+
+            # Kept in memory only, upscaled like the interactive view. The
+            # render above left pyrender's context current, not ours
+            self.makeCurrent()
+            gl.glPixelZoom(self.width / self.frames.width, self.height / self.frames.height)
+            self.frames.draw()
+            gl.glPixelZoom(1, 1)
 
         elif self.app.programState == ProgramStates.RENDERING:
             if self.app.currentFrame >= self.app.numberOfFrames:
+                # Save the frames still in flight
+                for frame in self.offscreenRenderer.finishAsyncReadback():
+                    self.saveFrame(frame)
+
                 self.app.programState = ProgramStates.POSITIONING
                 self.app.currentFrame = 0
                 return
 
             for modName in self.models:
                 mod = self.models[modName]
-                gl.glPushMatrix()
 
-                def lerpP(a, b, p):
-                    return a * p + (1 - p) * b
-
-                start = mod.getStart()[1]
-                frames, end = mod.getEnd()
+                # Parts without keyframes keep their positioning pose
+                if not mod.hasKeyframes() or mod.node is None or not self.scene.has_node(mod.node):
+                    continue
 
-                perc = float(self.app.currentFrame) / frames
+                self.scene.set_pose(mod.node, pose=mod.poseAt(self.app.currentFrame))
 
-                if perc <= 1:
-                    trans = (
-                        lerpP(float(end[0]), float(start[0]), perc),
-                        lerpP(float(end[1]), float(start[1]), perc),
-                        lerpP(float(end[2]), float(start[2]), perc),
-                    )
-
-                    gl.glTranslate(*trans)
+            # Held frames are written out along with the frame they repeat,
+            # which may still be reading back
+            state = sceneState(self.scene)
+            if state == self.renderedState:
+                if self.savedFrame == self.renderedFrame:
+                    linkFrame(f"./tmp_frames/{self.savedFrame}.bmp",
+                              f"./tmp_frames/{self.app.currentFrame}.bmp")
                 else:
-                    gl.glTranslate(*end)
-
-                gl.glRotatef(mod.rotation[0], 1, 0, 0)
-                gl.glRotatef(mod.rotation[1], 0, 1, 0)
-                gl.glRotatef(mod.rotation[2], 0, 0, 1)
-
-                gl.glScale(*mod.scale)
-
-                mod.draw()
-                gl.glPopMatrix()
-
-            # Capture the frame
-            buff = gl.glReadPixels(
-                    0, 0,
-                    self.width, self.height,
-                    gl.GL_RGB, gl.GL_UNSIGNED_BYTE)
-
-            imgName = f"./tmp_frames/{self.app.currentFrame}.bmp"
-            imout = Image.frombytes(
-                    mode="RGB", size=(self.width, self.height), data=buff)
-            imout = imout.transpose(Image.FLIP_TOP_BOTTOM)
+                    self.heldFrames.setdefault(self.renderedFrame, []).append(self.app.currentFrame)
+                self.frames.draw()
+                print(f"Holding Frame {self.app.currentFrame}")
+            else:
+                self.offscreenRenderer.viewport_width = self.width
+                self.offscreenRenderer.viewport_height = self.height
+                self.offscreenRenderer.render(self.scene, tag=self.app.currentFrame)
+                self.renderedState = state
+                self.renderedFrame = self.app.currentFrame
+
+                # pyrender leaves its own context current (or none at all),
+                # the pixels have to go to the widget's
+                self.makeCurrent()
+                self.frames.draw()
+
+                # Capture whichever frame has finished reading back, with
+                # asynchronous readback that lags a couple of frames behind
+                if self.frames.tag is not None:
+                    self.saveFrame(self.frames.tag)
+
+                print(f"Rendering Frame {self.app.currentFrame}")
 
             self.app.frameSlider.setValue(self.app.currentFrame)
 
-            print(f"Rendering Frame {self.app.currentFrame}")
-
-            imout.save(imgName)
-
             self.app.currentFrame += 1
 
 
 class Model():
-    def __init__(self, tmesh, mesh, node, app):
-        self.tmesh = tmesh
-        self.mesh = mesh
-        self.node = node
+    def __init__(self, geometry, app, source=None):
+        self.source = source  # Where the geometry can be loaded from again
+        self.loadedGeometry = geometry
+        self.mesh = None
+        self.node = None
         self.app = app
         self.scene = app.glWidget.scene
 
         self.showing = True
+        self.baseColor = (0.5, 0.5, 0.5, 1.0)
 
         self.translation = (0, 0, 0)
         self.rotation = (0, 0, 0)
@@ -746,30 +1194,97 @@ class Model():
         self.keyframes = {}
         for i in range(0, 360):
             self.keyframes[i] = None
+        self.keyedFrames = []
+
+    @property
+    def geometry(self):
+        # Reloaded from the source if the memory manager dropped it
+        if self.loadedGeometry is None:
+            self.loadedGeometry = loadGeometry(self.source)
+        return self.loadedGeometry
 
     @property
     def color(self):
-        return tuple(self.tmesh.visual.vertex_colors[0])
+        return self.baseColor
 
     @color.setter
     def color(self, new_val):
-        self.tmesh.visual.vertex_colors = [new_val for i in range(0, self.tmesh.vertices.shape[0])]
-        self.mesh = pyrender.Mesh.from_trimesh(self.tmesh)
+        # RGB(A) in 0..1, it ends up in the material rather than per vertex
+        self.baseColor = tuple(new_val) + (1.0,) * (4 - len(new_val))
 
         # Re add itself to the scene I guess...
-        self.scene.remove_node(self.node)
-        self.node = None
+        # (it may currently be baked into the static batch instead)
+        self.dropMesh()
+        self.buildMesh()
+        if self.showing:
+            self.scene.add_node(self.node)
+
+    def buildMesh(self):
+        self.mesh = self.geometry.toPyrender(self.baseColor)
         self.node = pyrender.Node(mesh=self.mesh, matrix=np.eye(4))
-        self.scene.add_node(self.node)
+
+    def dropMesh(self):
+        if self.node is not None and self.scene.has_node(self.node):
+            self.scene.remove_node(self.node)
+        self.mesh = None
+        self.node = None
+
+    def dropGeometry(self):
+        # Only when it can be loaded again
+        if self.source is not None:
+            self.loadedGeometry = None
+
+    def poseMatrix(self, translation=None, rotation=None):
+        if translation is None:
+            translation = self.translation
+        if rotation is None:
+            rotation = self.rotation
+
+        trans = (
+            translation[0] / 100.0,
+            translation[1] / 100.0,
+            translation[2] / 100.0)
+
+        modelView = translate(trans)
+        modelView = modelView * rotx(rotation[0] + 90.0)
+        modelView = modelView * roty(rotation[1])
+        modelView = modelView * rotz(rotation[2] + 180)
+        modelView = modelView * scale(self.scale)
+        return np.array(modelView)
+
+    def poseAt(self, frame):
+        return self.posesAt([frame])[0]
+
+    def posesAt(self, frames):
+        # (len(frames), 4, 4) poses, the keyframe lerp for every frame at once
+        poses = np.repeat(self.poseMatrix()[None], len(frames), axis=0)
+        if not self.hasKeyframes():
+            return poses
+
+        start = np.array(self.getStart()[1], dtype=np.float64)
+        count, end = self.getEnd()
+        end = np.array(end, dtype=np.float64)
+
+        frames = np.asarray(frames, dtype=np.float64)
+        perc = np.minimum(frames / count, 1.0) if count > 0 else np.ones(len(frames))
+        poses[:, :3, 3] = (perc[:, None] * end + (1 - perc[:, None]) * start) / 100.0
+        return poses
 
     def setKeyFrame(self, currentFrame):
-        pass
+        frame = int(currentFrame or 0)
+        self.keyframes[frame] = (self.translation, self.rotation)
+        self.keyedFrames = sorted(f for f, k in self.keyframes.items() if k is not None)
+
+    def hasKeyframes(self):
+        return len(self.keyedFrames) > 0
 
     def getStart(self):
-        pass
+        frame = self.keyedFrames[0]
+        return frame, self.keyframes[frame][0]
 
     def getEnd(self):
-        pass
+        frame = self.keyedFrames[-1]
+        return frame, self.keyframes[frame][0]
 
 
 if __name__ == '__main__':
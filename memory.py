@@ -0,0 +1,179 @@
+import time
+import numpy as np
+
+from bvh import boxCorners, meshBVHs
+
+
+MEGABYTE = 1024 * 1024
+
+HOST_BUDGET = 2048 * MEGABYTE
+GPU_BUDGET = 1024 * MEGABYTE
+
+
+def meshBytes(mesh):
+    # Float arrays pyrender keeps on the host for a mesh
+    if mesh is None:
+        return 0
+    total = 0
+    for primitive in mesh.primitives:
+        for array in (primitive.positions, primitive.normals, primitive.indices, primitive.color_0):
+            if array is not None:
+                total += array.nbytes
+    return total
+
+
+def uploadBytes(mesh):
+    # What the same mesh costs in GPU buffers: float32 attributes, uint32 indices
+    if mesh is None:
+        return 0
+    total = 0
+    for primitive in mesh.primitives:
+        vertices = len(primitive.positions)
+        total += vertices * 4 * (3 + 3 + (4 if primitive.color_0 is not None else 0))
+        if primitive.indices is not None:
+            total += primitive.indices.size * 4
+    return total
+
+
+def boxesInView(lo, hi, viewProjection):
+    # Conservative frustum test for n world boxes, False only when all eight
+    # corners are past the same clip plane
+    corners = boxCorners(lo, hi)
+    clip = np.concatenate([corners, np.ones(corners.shape[:2] + (1,))], axis=2) @ viewProjection.T
+    xyz, w = clip[..., :3], clip[..., 3:]
+    outside = np.any(np.all(xyz < -w, axis=1) | np.all(xyz > w, axis=1), axis=1)
+    return ~outside
+
+
+class MemoryManager():
+    """
+    Keeps host and GPU memory under budget. Only models in the scene are on
+    the GPU (pyrender frees a mesh's buffers once its node is gone), so
+    hidden models leave the scene straight away and models out of view
+    leave it, least recently seen first, when the GPU budget is exceeded.
+    Over the host budget, models that aren't drawn lose their pyrender mesh
+    and hidden ones their geometry as well, both come back from the
+    mesh source when the model is needed again.
+    """
+
+    def __init__(self, scene, hostBudget=HOST_BUDGET, gpuBudget=GPU_BUDGET, interval=15):
+        self.scene = scene
+        self.hostBudget = hostBudget
+        self.gpuBudget = gpuBudget
+        self.interval = interval
+
+        self.frames = 0
+        self.lastVisible = {}  # name -> time the model was last in view
+        self.hostBytes = 0
+        self.gpuBytes = 0
+        self.resident = 0
+        self.total = 0
+
+    def footprint(self, mod):
+        # (host, gpu) bytes for one model
+        host = meshBytes(mod.mesh)
+        if mod.loadedGeometry is not None:
+            host += mod.loadedGeometry.nbytes()
+            bvh = meshBVHs.get(mod.loadedGeometry)
+            if bvh is not None:
+                host += bvh.nbytes()
+
+        drawn = mod.node is not None and self.scene.has_node(mod.node)
+        return host, uploadBytes(mod.mesh) if drawn else 0
+
+    def hide(self, mod):
+        if mod.node is not None and self.scene.has_node(mod.node):
+            self.scene.remove_node(mod.node)
+
+    def show(self, mod):
+        # Reloads whatever was evicted and puts the model back in the scene
+        if mod.node is None:
+            mod.buildMesh()
+        if not self.scene.has_node(mod.node):
+            self.scene.add_node(mod.node)
+            self.scene.set_pose(mod.node, pose=mod.poseMatrix())
+
+    def restore(self, models, staticBatch):
+        # Everything visible back in the scene, e.g. before the animation
+        # moves things into view
+        for name, mod in models.items():
+            if mod.showing and not staticBatch.holds(name, mod):
+                self.show(mod)
+
+    def update(self, models, staticBatch, viewProjection, force=False):
+        # True when it actually ran, it only looks every interval frames
+        self.frames += 1
+        if not force and self.frames % self.interval:
+            return False
+
+        now = time.time()
+        names = [name for name, mod in models.items() if mod.showing]
+        for name, mod in models.items():
+            if not mod.showing:
+                self.hide(mod)
+
+        # Only parts drawn by themselves can leave, batched ones are already
+        # a single mesh
+        if names:
+            bounds = np.array([models[name].geometry.bounds() for name in names])
+            poses = np.array([models[name].poseMatrix() for name in names])
+            corners = boxCorners(bounds[:, 0], bounds[:, 1])
+            world = np.einsum('mij,mkj->mki', poses[:, :3, :3], corners) + poses[:, None, :3, 3]
+            inView = boxesInView(world.min(axis=1), world.max(axis=1), viewProjection)
+        else:
+            inView = []
+
+        offscreen = []
+        for name, visible in zip(names, inView):
+            mod = models[name]
+            if visible:
+                self.lastVisible[name] = now
+                if not staticBatch.holds(name, mod):
+                    self.show(mod)
+            elif not staticBatch.holds(name, mod):
+                offscreen.append(name)
+
+        footprints = {name: self.footprint(mod) for name, mod in models.items()}
+        gpuBytes = sum(gpu for host, gpu in footprints.values())
+        hostBytes = sum(host for host, gpu in footprints.values())
+        if staticBatch.node is not None:
+            gpuBytes += uploadBytes(staticBatch.node.mesh)
+            hostBytes += meshBytes(staticBatch.node.mesh)
+
+        # Out of view parts leave the GPU, least recently seen first
+        offscreen.sort(key=lambda name: self.lastVisible.get(name, 0))
+        for name in offscreen:
+            if gpuBytes <= self.gpuBudget:
+                break
+            self.hide(models[name])
+            gpuBytes -= footprints[name][1]
+
+        # Parts that aren't drawn drop their host copies, hidden ones all the
+        # way down to the geometry
+        if hostBytes > self.hostBudget:
+            idle = [name for name, mod in models.items()
+                    if not staticBatch.holds(name, mod) and
+                    (mod.node is None or not self.scene.has_node(mod.node))]
+            idle.sort(key=lambda name: (models[name].showing, self.lastVisible.get(name, 0)))
+            for name in idle:
+                if hostBytes <= self.hostBudget:
+                    break
+                mod = models[name]
+                before = self.footprint(mod)[0]
+                mod.dropMesh()
+                if not mod.showing:
+                    mod.dropGeometry()
+                hostBytes -= before - self.footprint(mod)[0]
+
+        self.hostBytes = hostBytes
+        self.gpuBytes = gpuBytes
+        self.resident = sum(1 for name, mod in models.items()
+                            if staticBatch.holds(name, mod) or
+                            (mod.node is not None and self.scene.has_node(mod.node)))
+        self.total = len(models)
+        return True
+
+    def usage(self):
+        return (f"Host {self.hostBytes / MEGABYTE:.0f}/{self.hostBudget / MEGABYTE:.0f} MB, "
+                f"GPU {self.gpuBytes / MEGABYTE:.0f}/{self.gpuBudget / MEGABYTE:.0f} MB, "
+                f"{self.resident}/{self.total} parts drawn")
@@ -0,0 +1,179 @@
+import os
+import struct
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from bvh import meshBVHs
+from collision import buildBVH
+
+
+# Occlusion file: header, then one byte of visibility per vertex
+OCCLUSION_MAGIC = b'STLAO8\0\0'
+OCCLUSION_HEADER = struct.Struct('<8sQHd')
+OCCLUSION_SUFFIX = '.stlao'
+
+OCCLUSION_RAYS = 16
+
+# Occluders further away than this fraction of the part's bounding box
+# diagonal don't count
+OCCLUSION_DISTANCE = 0.2
+
+# Vertices per task handed to a worker
+OCCLUSION_BATCH = 1024
+
+GOLDEN_ANGLE = np.pi * (3.0 - np.sqrt(5.0))
+
+
+def hemisphereDirections(count):
+    # Cosine weighted directions around +z on a spiral, the same set every
+    # time so bakes are repeatable
+    i = np.arange(count) + 0.5
+    r = np.sqrt(i / count)
+    phi = i * GOLDEN_ANGLE
+    return np.column_stack([r * np.cos(phi), r * np.sin(phi), np.sqrt(1.0 - r * r)])
+
+
+def tangentFrames(normals):
+    # Two unit vectors perpendicular to each normal and to each other,
+    # branchless so it vectorizes (Duff et al. 2017)
+    x, y, z = normals[:, 0], normals[:, 1], normals[:, 2]
+    sign = np.where(z >= 0, 1.0, -1.0)
+    a = -1.0 / (sign + z)
+    b = x * y * a
+    tangent = np.column_stack([1.0 + sign * x * x * a, sign * b, -sign * x])
+    bitangent = np.column_stack([b, sign + y * y * a, -y])
+    return tangent, bitangent
+
+
+def vertexVisibility(bvh, vertices, normals, first, rays, distance):
+    # Fraction of the cosine weighted hemisphere above each vertex that
+    # nothing within distance blocks, as 0..255
+    tangent, bitangent = tangentFrames(normals)
+    local = hemisphereDirections(rays)
+
+    # Every vertex turns the spiral by its own angle, so neighbours sample
+    # different directions and the error is noise rather than banding
+    angle = (np.arange(first, first + len(vertices)) * GOLDEN_ANGLE)[:, None]
+    x = np.cos(angle) * local[:, 0] - np.sin(angle) * local[:, 1]
+    y = np.sin(angle) * local[:, 0] + np.cos(angle) * local[:, 1]
+    directions = (x[..., None] * tangent[:, None] + y[..., None] * bitangent[:, None] +
+                  local[:, 2, None] * normals[:, None])
+
+    # Off the surface a little so rays don't hit the faces they start on
+    origins = np.repeat(vertices + normals * (distance * 1e-3), rays, axis=0)
+    nearest, triangle = bvh.intersectRays(origins, directions.reshape(-1, 3), distance)
+    blocked = (triangle >= 0).reshape(len(vertices), rays).mean(axis=1)
+    return np.round((1.0 - blocked) * 255).astype(np.uint8)
+
+
+workerParts = None
+
+
+def initWorker(parts):
+    global workerParts
+    workerParts = parts
+
+
+def bakeBatch(task):
+    m, first, last, rays = task
+    bvh, vertices, normals, distance = workerParts[m]
+    return vertexVisibility(bvh, vertices[first:last], normals[first:last], first, rays, distance)
+
+
+def bakeOcclusion(geometries, rays=OCCLUSION_RAYS, distance=OCCLUSION_DISTANCE, workers=None):
+    """
+    Per-vertex ambient occlusion for every geometry, in its own local space
+    and against itself only, so it holds however the part is posed. Returns
+    a uint8 visibility array per geometry, 255 fully open.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Triangle BVHs are built once per mesh, in parallel, and kept for next time
+    missing = [g for g in geometries if g not in meshBVHs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for geometry, bvh in zip(missing, pool.map(buildBVH, missing)):
+            meshBVHs[geometry] = bvh
+
+    parts = {}
+    tasks = []
+    for m, geometry in enumerate(geometries):
+        vertices = geometry.vertices().astype(np.float64)
+        parts[m] = (meshBVHs[geometry], vertices, geometry.vertexNormals().astype(np.float64),
+                    distance * float(np.linalg.norm(geometry.extent)))
+        for first in range(0, len(vertices), OCCLUSION_BATCH):
+            tasks.append((m, first, min(first + OCCLUSION_BATCH, len(vertices)), rays))
+
+    visibility = [[] for geometry in geometries]
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(parts,)) as pool:
+        for (m, first, last, rays), batch in zip(tasks, pool.map(bakeBatch, tasks)):
+            visibility[m].append(batch)
+    return [np.concatenate(v) if v else np.empty(0, dtype=np.uint8) for v in visibility]
+
+
+def saveOcclusion(fileName, visibility, rays=OCCLUSION_RAYS, distance=OCCLUSION_DISTANCE):
+    # Next to the source, like the compact mesh cache
+    with open(fileName + OCCLUSION_SUFFIX, 'wb') as f:
+        f.write(OCCLUSION_HEADER.pack(OCCLUSION_MAGIC, len(visibility), rays, distance))
+        f.write(visibility.astype(np.uint8))
+
+
+def loadOcclusion(fileName, vertexCount):
+    # The baked visibility if there is one for this source and it's still
+    # current, None otherwise
+    cacheName = fileName + OCCLUSION_SUFFIX
+    if not os.path.exists(cacheName) or os.path.getmtime(cacheName) < os.path.getmtime(fileName):
+        return None
+
+    with open(cacheName, 'rb') as f:
+        magic, count, rays, distance = OCCLUSION_HEADER.unpack(f.read(OCCLUSION_HEADER.size))
+        if magic != OCCLUSION_MAGIC or count != vertexCount:
+            return None
+        return np.fromfile(f, dtype=np.uint8, count=count)
+
+
+class OcclusionBaker(QThread):
+    # Emits the visibility per geometry once all of them are baked, and an
+    # error message, empty unless the bake itself failed. Always emits
+    baked = pyqtSignal(list, str)
+
+    def __init__(self, sources, geometries, rays=OCCLUSION_RAYS, workers=None, parent=None):
+        super().__init__(parent)
+        self.sources = sources
+        self.geometries = geometries
+        self.rays = rays
+        self.workers = workers
+
+    def run(self):
+        try:
+            visibility = bakeOcclusion(self.geometries, self.rays, workers=self.workers)
+        except Exception as e:
+            self.baked.emit([], f"{type(e).__name__}: {e}")
+            return
+        for source, v in zip(self.sources, visibility):
+            if source is not None:
+                try:
+                    saveOcclusion(source, v, self.rays)
+                except OSError:
+                    pass
+        self.baked.emit(visibility, "")
+
+
+if __name__ == '__main__':
+    # Bakes STL files ahead of time, e.g. on the machine the render workers
+    # share their parts from
+    import sys
+    import time
+    from assembly import loadGeometry
+
+    fileNames = sys.argv[1:] or ['stl_files/z-assm.stl']
+    geometries = [loadGeometry(fileName) for fileName in fileNames]
+
+    start = time.time()
+    for fileName, geometry, v in zip(fileNames, geometries, bakeOcclusion(geometries)):
+        saveOcclusion(fileName, v)
+        print(f"{fileName}: {len(v)} vertices, mean visibility {v.mean() / 255:.2f}")
+    print(f"Baked in {time.time() - start:.1f}s")
@@ -0,0 +1,105 @@
+import threading
+import numpy as np
+
+from bvh import BVH, meshBVH
+from collision import worldBounds
+
+
+def cameraRay(cameraPose, yfov, aspectRatio, x, y, width, height):
+    # World space ray through pixel (x, y), pyrender cameras look down -z
+    ndcX = 2.0 * (x + 0.5) / width - 1.0
+    ndcY = 1.0 - 2.0 * (y + 0.5) / height
+    h = np.tan(yfov / 2.0)
+    direction = np.array([ndcX * h * aspectRatio, ndcY * h, -1.0])
+
+    cameraPose = np.asarray(cameraPose)
+    direction = cameraPose[:3, :3] @ direction
+    return cameraPose[:3, 3].copy(), direction / np.linalg.norm(direction)
+
+
+class Picker():
+    """
+    Finds the model under a ray. A BVH over the posed bounds of every visible
+    model narrows it down to a few parts, their own triangle BVHs (local
+    space, so they never change with the pose) give the exact hit. The scene
+    BVH is refit when models move and only rebuilt when the set changes.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.geometries = []
+        self.states = []
+        self.poses = None
+        self.inverses = None
+        self.bounds = None
+        self.bvh = None
+
+    def stateKey(self, mod):
+        return (mod.translation, mod.rotation, mod.scale)
+
+    def update(self, models):
+        names = [name for name, mod in models.items() if mod.showing]
+        geometries = [models[name].geometry for name in names]
+        states = [self.stateKey(models[name]) for name in names]
+
+        rebuild = names != self.names or any(a is not b for a, b in zip(geometries, self.geometries))
+        if not rebuild and states == self.states:
+            return
+
+        if rebuild:
+            self.bounds = np.array([geometry.bounds() for geometry in geometries]).reshape(-1, 2, 3)
+            self.poses = np.empty((len(names), 4, 4))
+            moved = range(len(names))
+        else:
+            moved = [i for i, (a, b) in enumerate(zip(states, self.states)) if a != b]
+
+        for i in moved:
+            self.poses[i] = models[names[i]].poseMatrix()
+        self.inverses = np.linalg.inv(self.poses) if len(names) else self.poses
+
+        self.names = names
+        self.geometries = geometries
+        self.states = states
+        if not names:
+            self.bvh = None
+            return
+
+        lo, hi = worldBounds(self.bounds[:, 0], self.bounds[:, 1], self.poses[None])
+        if rebuild:
+            self.bvh = BVH(lo[0], hi[0], leafSize=4)
+        else:
+            self.bvh.refit(lo[0], hi[0])
+
+    def warm(self, geometries):
+        # Triangle BVHs for big parts take a while, build them before the
+        # first click needs them
+        def build():
+            for geometry in geometries:
+                meshBVH(geometry).lists()
+        threading.Thread(target=build, daemon=True).start()
+
+    def pick(self, origin, direction):
+        # (name, distance) of the nearest model along the ray, or None
+        if self.bvh is None:
+            return None
+
+        def hitLeaf(leaf, tMax):
+            nearest = None
+            first = self.bvh.start[leaf]
+            for m in self.bvh.order[first:first + self.bvh.count[leaf]]:
+                inverse = self.inverses[m]
+                localOrigin = inverse[:3, :3] @ origin + inverse[:3, 3]
+                localDirection = inverse[:3, :3] @ direction
+
+                # The ray parameter survives the affine transform, so
+                # distances stay comparable between parts
+                hit = meshBVH(self.geometries[m]).intersectRay(localOrigin, localDirection, tMax)
+                if hit is not None:
+                    tMax = hit[0]
+                    nearest = (tMax, self.names[m])
+            return nearest
+
+        hit = self.bvh.nearestHit(origin, direction, np.inf, hitLeaf)
+        if hit is None:
+            return None
+        return hit[1], hit[0]
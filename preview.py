@@ -0,0 +1,87 @@
+import weakref
+import numpy as np
+import pyrender
+
+from staticbatch import mergedMesh
+
+
+# Grid cells along each axis of a part's bounding box for its draft mesh
+DRAFT_CELLS = 16
+
+# Fixed key light baked into draft colours, drafts are drawn unlit
+DRAFT_LIGHT = np.array([0.3, 0.8, 0.5]) / np.linalg.norm([0.3, 0.8, 0.5])
+
+# Draft meshes per geometry, dropped together with the geometry
+draftMeshes = weakref.WeakKeyDictionary()
+
+
+def draftMesh(geometry, cells=DRAFT_CELLS):
+    # Made again when the occlusion was baked since
+    cached = draftMeshes.get(geometry)
+    if cached is None or cached[0] != cells or cached[1] is not geometry.occlusion:
+        cached = (cells, geometry.occlusion, geometry.simplified(cells))
+        draftMeshes[geometry] = cached
+    return cached[2]
+
+
+class DraftPreview():
+    """
+    Stand-in scene for playing the animation back at speed. Every part is
+    swapped for a vertex-clustered draft of itself and everything that
+    doesn't move is merged into a single mesh, so a frame is a few draw
+    calls over a few thousand triangles each. Shading is baked into the
+    vertex colours so it can be drawn with the flat shader. Poses for
+    every frame are worked out up front, playing a frame only sets them.
+    """
+
+    def __init__(self, cells=DRAFT_CELLS):
+        self.cells = cells
+        self.scene = None
+        self.cameraNode = None
+        self.poses = []  # (node, pose per frame) for each moving part
+
+    def build(self, scene, models, frames):
+        self.scene = pyrender.Scene(bg_color=scene.bg_color, ambient_light=scene.ambient_light)
+        cameraNode = scene.main_camera_node
+        self.cameraNode = pyrender.Node(camera=cameraNode.camera, matrix=scene.get_pose(cameraNode))
+        self.scene.add_node(self.cameraNode)
+        for node in scene.light_nodes:
+            self.scene.add_node(pyrender.Node(light=node.light, matrix=scene.get_pose(node)))
+
+        frameNumbers = np.arange(frames)
+        static = []
+        self.poses = []
+        for mod in models.values():
+            if not mod.showing:
+                continue
+            draft = draftMesh(mod.geometry, self.cells)
+            if mod.hasKeyframes():
+                # Baked at the first frame's pose, later frames move it
+                # relative to that
+                poses = mod.posesAt(frameNumbers)
+                mesh = mergedMesh([(draft, poses[0], mod.color)], DRAFT_LIGHT)
+                node = pyrender.Node(mesh=mesh, matrix=np.eye(4))
+                self.scene.add_node(node)
+                self.poses.append((node, poses @ np.linalg.inv(poses[0])))
+            else:
+                static.append((draft, mod.poseMatrix(), mod.color))
+
+        if static:
+            mesh = mergedMesh(static, DRAFT_LIGHT)
+            self.scene.add_node(pyrender.Node(mesh=mesh, matrix=np.eye(4)))
+
+    def update(self, cameraPose, frame):
+        # The camera can still be moved around while it plays
+        self.scene.set_pose(self.cameraNode, pose=cameraPose)
+        for node, poses in self.poses:
+            self.scene.set_pose(node, pose=poses[frame])
+
+    def triangles(self):
+        return sum(len(primitive.indices) for node in self.scene.mesh_nodes
+                   for primitive in node.mesh.primitives)
+
+    def clear(self):
+        # Renderer drops the GPU buffers the next time it draws another scene
+        self.scene = None
+        self.cameraNode = None
+        self.poses = []
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 import tempfile
 from base64 import b64encode
+from bisect import bisect_right
 
 from PyQt5 import QtWidgets, QtGui, QtCore
 from PyQt5.QtCore import Qt, QPoint, QLine, QRect, QRectF, pyqtSignal
@@ -14,6 +15,9 @@ from numpy import load
 
 __textColor__ = QColor(187, 187, 187)
 __backgroudColor__ = QColor(60, 63, 65)
+__markerColor__ = QColor(220, 180, 60)
+__rangeColor__ = QColor(200, 60, 60)
+__progressColor__ = QColor(90, 200, 90)
 __font__ = QFont('Decorative', 10)
 
 
@@ -44,14 +48,23 @@ class QTimeLine(QWidget):
         # Set variables
         self.backgroundColor = __backgroudColor__
         self.textColor = __textColor__
+        self.markerColor = __markerColor__
+        self.rangeColor = __rangeColor__
+        self.progressColor = __progressColor__
         self.font = __font__
         self.pos = None
         self.pointerPos = None
         self.pointerTimePos = None
         self.selectedSample = None
+        self.highlightedSample = None  # Sample currently drawn in the selection color
         self.clicking = False  # Check if mouse left button is being pressed
         self.is_in = False  # check if user is in the widget
         self.videoSamples = []  # List of videos samples
+        self.sampleStarts = []  # Sorted sample start positions, for bisecting
+        self.markers = []  # Sorted keyframe marker positions
+        self.ranges = []  # Sorted (first, last) frame ranges to flag, e.g. collisions
+        self.progress = []  # Sorted (first, last) frame ranges already rendered
+        self.cache = None  # Ruler and sample track, rebuilt on resize, zoom or data change
 
         self.setMouseTracking(True)  # Mouse events
         self.setAutoFillBackground(True)  # background
@@ -70,8 +83,40 @@ class QTimeLine(QWidget):
         self.setPalette(pal)
 
     def paintEvent(self, event):
+        if self.cache is None or self.cache.size() != self.size():
+            self.rebuildCache()
+
         qp = QPainter()
         qp.begin(self)
+
+        # Only the dirty part of the static ruler and track
+        rect = event.rect()
+        qp.drawPixmap(rect, self.cache, rect)
+
+        qp.setRenderHint(QPainter.Antialiasing)
+        qp.setPen(QPen(self.textColor))
+        if self.pos is not None and self.is_in:
+            qp.drawLine(self.pos.x(), 0, self.pos.x(), 40)
+
+        x = self.pointerX()
+        line = QLine(QPoint(x, 40), QPoint(x, self.height()))
+        poly = QPolygon([QPoint(x - 10, 20), QPoint(x + 10, 20), QPoint(x, 40)])
+
+        # Draw pointer
+        qp.setPen(Qt.darkCyan)
+        qp.setBrush(QBrush(Qt.darkCyan))
+
+        qp.drawPolygon(poly)
+        qp.drawLine(line)
+        qp.end()
+
+    def rebuildCache(self):
+        self.cache = QPixmap(self.size())
+        self.cache.fill(self.backgroundColor)
+        self.layoutSamples()
+
+        qp = QPainter()
+        qp.begin(self.cache)
         qp.setPen(self.textColor)
         qp.setFont(self.font)
         qp.setRenderHint(QPainter.Antialiasing)
@@ -96,89 +141,137 @@ class QTimeLine(QWidget):
                 qp.drawLine(3 * point, 40, 3 * point, 20)
             point += 10
 
-        if self.pos is not None and self.is_in:
-            qp.drawLine(self.pos.x(), 0, self.pos.x(), 40)
+        # Draw rendered frames over the ruler line
+        end = bisect_right(self.progress, (self.width(),))
+        for first, last in self.progress[:end]:
+            qp.fillRect(first, 38, last - first + 1, 5, self.progressColor)
 
-        if self.pointerPos is not None:
-            line = QLine(QPoint(self.pointerTimePos/self.getScale(), 40),
-                         QPoint(self.pointerTimePos/self.getScale(), self.height()))
-            poly = QPolygon([QPoint(self.pointerTimePos/self.getScale() - 10, 20),
-                             QPoint(self.pointerTimePos/self.getScale() + 10, 20),
-                             QPoint(self.pointerTimePos/self.getScale(), 40)])
-        else:
-            line = QLine(QPoint(0, 0), QPoint(0, self.height()))
-            poly = QPolygon([QPoint(-10, 20), QPoint(10, 20), QPoint(0, 40)])
+        # Draw flagged ranges under the markers
+        end = bisect_right(self.ranges, (self.width(),))
+        for first, last in self.ranges[:end]:
+            qp.fillRect(first, 42, last - first + 1, 7, self.rangeColor)
+
+        # Draw keyframe markers, just the visible ones in one batch
+        end = bisect_right(self.markers, self.width())
+        qp.setPen(QPen(self.markerColor))
+        qp.drawLines([QLine(x, 42, x, 48) for x in self.markers[:end]])
 
         # Draw samples
+        first, last = self.samplesBetween(0, self.width())
+        for sample in self.videoSamples[first:last]:
+            self.drawSample(qp, sample)
+
+        qp.end()
+
+    def layoutSamples(self):
+        scale = self.getScale()
         t = 0
         for sample in self.videoSamples:
-            # Clear clip path
-            path = QPainterPath()
-            path.addRoundedRect(QRectF(t / scale, 50, sample.duration / scale, 200), 10, 10)
-            qp.setClipPath(path)
-
-            # Draw sample
-            path = QPainterPath()
-            qp.setPen(sample.color)
-            path.addRoundedRect(QRectF(t/scale, 50, sample.duration/scale, 50), 10, 10)
             sample.startPos = t/scale
             sample.endPos = t/scale + sample.duration/scale
-            qp.fillPath(path, sample.color)
-            qp.drawPath(path)
-
-            # Draw preview pictures
-            if sample.picture is not None:
-                if sample.picture.size().width() < sample.duration/scale:
-                    path = QPainterPath()
-                    path.addRoundedRect(QRectF(t/scale, 52.5, sample.picture.size().width(), 45), 10, 10)
-                    qp.setClipPath(path)
-                    qp.drawPixmap(QRect(t/scale, 52.5, sample.picture.size().width(), 45), sample.picture)
-                else:
-                    path = QPainterPath()
-                    path.addRoundedRect(QRectF(t / scale, 52.5, sample.duration/scale, 45), 10, 10)
-                    qp.setClipPath(path)
-                    pic = sample.picture.copy(0, 0, sample.duration/scale, 45)
-                    qp.drawPixmap(QRect(t / scale, 52.5, sample.duration/scale, 45), pic)
             t += sample.duration
+        self.sampleStarts = [sample.startPos for sample in self.videoSamples]
+
+    def samplesBetween(self, x0, x1):
+        # Index range of the samples overlapping [x0, x1]
+        first = max(0, bisect_right(self.sampleStarts, x0) - 1)
+        last = bisect_right(self.sampleStarts, x1)
+        return first, last
+
+    def sampleRect(self, sample):
+        return QRectF(sample.startPos, 50, sample.endPos - sample.startPos, 200)
+
+    def drawSample(self, qp, sample):
+        start = sample.startPos
+        width = sample.endPos - sample.startPos
 
         # Clear clip path
         path = QPainterPath()
-        path.addRect(self.rect().x(), self.rect().y(), self.rect().width(), self.rect().height())
+        path.addRoundedRect(self.sampleRect(sample), 10, 10)
         qp.setClipPath(path)
 
-        # Draw pointer
-        qp.setPen(Qt.darkCyan)
-        qp.setBrush(QBrush(Qt.darkCyan))
+        # Draw sample
+        path = QPainterPath()
+        qp.setPen(sample.color)
+        path.addRoundedRect(QRectF(start, 50, width, 50), 10, 10)
+        qp.fillPath(path, sample.color)
+        qp.drawPath(path)
+
+        # Draw preview pictures
+        if sample.picture is not None:
+            if sample.picture.size().width() < width:
+                path = QPainterPath()
+                path.addRoundedRect(QRectF(start, 52.5, sample.picture.size().width(), 45), 10, 10)
+                qp.setClipPath(path)
+                qp.drawPixmap(QRect(int(start), 52, sample.picture.size().width(), 45), sample.picture)
+            else:
+                path = QPainterPath()
+                path.addRoundedRect(QRectF(start, 52.5, width, 45), 10, 10)
+                qp.setClipPath(path)
+                pic = sample.picture.copy(0, 0, int(width), 45)
+                qp.drawPixmap(QRect(int(start), 52, int(width), 45), pic)
 
-        qp.drawPolygon(poly)
-        qp.drawLine(line)
+        qp.setClipping(False)
+
+    def redrawSample(self, sample):
+        # Repaint a single sample into the cache and mark just its strip dirty
+        if self.cache is None:
+            return
+
+        rect = self.sampleRect(sample)
+        qp = QPainter()
+        qp.begin(self.cache)
+        qp.setRenderHint(QPainter.Antialiasing)
+        qp.fillRect(rect, self.backgroundColor)
+        self.drawSample(qp, sample)
         qp.end()
 
+        self.update(rect.toAlignedRect())
+
+    def pointerX(self):
+        if self.pointerPos is None:
+            return 0
+        return int(self.pointerTimePos/self.getScale())
+
+    def pointerRect(self):
+        return QRect(self.pointerX() - 11, 0, 23, self.height())
+
+    def hoverRect(self, pos):
+        if pos is None:
+            return QRect()
+        return QRect(pos.x() - 1, 0, 3, 41)
+
+    def movePointer(self, x):
+        old = self.pointerRect()
+        self.pointerPos = x
+        self.pointerTimePos = self.pointerPos * self.getScale()
+        self.update(old)
+        self.update(self.pointerRect())
+
     # Mouse movement
     def mouseMoveEvent(self, e):
+        old = self.pos
         self.pos = e.pos()
 
         # if mouse is being pressed, update pointer
         if self.clicking:
             x = self.pos.x()
-            self.pointerPos = x
+            self.movePointer(x)
             self.positionChanged.emit(x)
             self.checkSelection(x)
-            self.pointerTimePos = self.pointerPos*self.getScale()
 
-        self.update()
+        self.update(self.hoverRect(old))
+        self.update(self.hoverRect(self.pos))
 
     # Mouse pressed
     def mousePressEvent(self, e):
         if e.button() == Qt.LeftButton:
             x = e.pos().x()
-            self.pointerPos = x
+            self.movePointer(x)
             self.positionChanged.emit(x)
-            self.pointerTimePos = self.pointerPos * self.getScale()
 
             self.checkSelection(x)
 
-            self.update()
             self.clicking = True  # Set clicking check to true
 
     # Mouse release
@@ -193,19 +286,33 @@ class QTimeLine(QWidget):
     # Leave
     def leaveEvent(self, e):
         self.is_in = False
-        self.update()
+        self.update(self.hoverRect(self.pos))
+
+    # Resize
+    def resizeEvent(self, e):
+        self.invalidate()
 
     # check selection
     def checkSelection(self, x):
         # Check if user clicked in video sample
-        for sample in self.videoSamples:
-            if sample.startPos < x < sample.endPos:
+        sample = None
+        first, last = self.samplesBetween(x, x)
+        for candidate in self.videoSamples[first:last]:
+            if candidate.startPos < x < candidate.endPos:
+                sample = candidate
+
+        if sample is not self.highlightedSample:
+            if self.highlightedSample is not None:
+                self.highlightedSample.color = self.highlightedSample.defColor
+                self.redrawSample(self.highlightedSample)
+            if sample is not None:
                 sample.color = Qt.darkCyan
-                if self.selectedSample is not sample:
-                    self.selectedSample = sample
-                    self.selectionChanged.emit(sample)
-            else:
-                sample.color = sample.defColor
+                self.redrawSample(sample)
+            self.highlightedSample = sample
+
+        if sample is not None and self.selectedSample is not sample:
+            self.selectedSample = sample
+            self.selectionChanged.emit(sample)
 
     # Get time string from seconds
     def get_time_string(self, seconds):
@@ -213,6 +320,10 @@ class QTimeLine(QWidget):
         h, m = divmod(m, 60)
         return "%02d:%02d:%02d" % (h, m, s)
 
+    # Throw away the cached ruler and track
+    def invalidate(self):
+        self.cache = None
+        self.update()
 
     # Get scale from length
     def getScale(self):
@@ -222,6 +333,41 @@ class QTimeLine(QWidget):
     def getDuration(self):
         return self.duration
 
+    # Set duration (zoom)
+    def setDuration(self, duration):
+        self.duration = duration
+        self.invalidate()
+
+    # Move the pointer to a frame
+    def setValue(self, value):
+        self.movePointer(value)
+
+    # Set video samples
+    def setSamples(self, samples):
+        self.videoSamples = list(samples)
+        self.highlightedSample = None
+        self.invalidate()
+
+    # Add a video sample
+    def addSample(self, sample):
+        self.videoSamples.append(sample)
+        self.invalidate()
+
+    # Set keyframe markers
+    def setMarkers(self, positions):
+        self.markers = sorted(int(p) for p in positions)
+        self.invalidate()
+
+    # Set flagged frame ranges, inclusive on both ends
+    def setRanges(self, ranges):
+        self.ranges = sorted((int(a), int(b)) for a, b in ranges)
+        self.invalidate()
+
+    # Set rendered frame ranges, inclusive on both ends
+    def setProgress(self, ranges):
+        self.progress = sorted((int(a), int(b)) for a, b in ranges)
+        self.invalidate()
+
     # Get selected sample
     def getSelectedSample(self):
         return self.selectedSample
@@ -229,11 +375,14 @@ class QTimeLine(QWidget):
     # Set background color
     def setBackgroundColor(self, color):
         self.backgroundColor = color
+        self.invalidate()
 
     # Set text color
     def setTextColor(self, color):
         self.textColor = color
+        self.invalidate()
 
     # Set Font
     def setTextFont(self, font):
         self.font = font
+        self.invalidate()
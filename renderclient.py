@@ -0,0 +1,44 @@
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from renderqueue import request
+
+
+def submitJob(server, scene, priority=0, chunkFrames=None, output=None):
+    job = {'scene': scene, 'priority': priority}
+    if chunkFrames is not None:
+        job['chunk'] = chunkFrames
+    if output is not None:
+        job['output'] = output
+
+    status, reply = request(server.rstrip('/'), 'POST', '/jobs', job)
+    if status != 201:
+        raise RuntimeError(f"Render service refused the job ({status})")
+    return reply['id']
+
+
+class RenderMonitor(QThread):
+    # Long polls a job's status and emits it whenever it changes, until the
+    # job is over
+    progress = pyqtSignal(dict)
+
+    def __init__(self, server, jobId, parent=None):
+        super().__init__(parent)
+        self.server = server.rstrip('/')
+        self.jobId = jobId
+
+    def run(self):
+        version = 0
+        while not self.isInterruptionRequested():
+            try:
+                code, status = request(self.server, 'GET', f"/jobs/{self.jobId}?since={version}")
+            except OSError:
+                self.msleep(1000)
+                continue
+            if status is None:
+                break
+
+            if status['version'] != version:
+                version = status['version']
+                self.progress.emit(status)
+            if status['state'] not in ('queued', 'rendering'):
+                break
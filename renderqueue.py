@@ -0,0 +1,513 @@
+import os
+import re
+import json
+import time
+import heapq
+import shutil
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+DEFAULT_PORT = 8765
+
+CHUNK_FRAMES = 10
+MAX_ATTEMPTS = 3
+
+# A worker that hasn't delivered a frame for this long loses its chunk
+LEASE_TIMEOUT = 60.0
+
+
+def frameRanges(frames):
+    # Sorted frame numbers to inclusive [first, last] runs
+    ranges = []
+    for frame in frames:
+        if ranges and ranges[-1][1] == frame - 1:
+            ranges[-1][1] = frame
+        else:
+            ranges.append([frame, frame])
+    return ranges
+
+
+def stageLink(source, directory):
+    # Same image under a temporary name of its own in directory, a hard
+    # link where the filesystem has them and a copy where it doesn't.
+    # Moved into place with os.replace, so concurrent writers of the same
+    # frame never share a half written file
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.part', delete=False) as f:
+        temporary = f.name
+    try:
+        os.remove(temporary)
+        os.link(source, temporary)
+    except OSError:
+        shutil.copyfile(source, temporary)
+    return temporary
+
+
+def linkFrame(source, target):
+    os.replace(stageLink(source, os.path.dirname(target) or '.'), target)
+
+
+def request(server, method, path, data=None, contentType='application/json'):
+    if data is not None and contentType == 'application/json':
+        data = json.dumps(data).encode()
+    req = urllib.request.Request(server + path, data=data, method=method)
+    if data is not None:
+        req.add_header('Content-Type', contentType)
+
+    try:
+        with urllib.request.urlopen(req) as response:
+            payload = response.read()
+            return response.status, json.loads(payload) if payload else None
+    except urllib.error.HTTPError as e:
+        return e.code, None
+
+
+class Chunk():
+    def __init__(self, job, index, first, last):
+        self.job = job
+        self.index = index
+        self.first = first
+        self.last = last
+        self.attempts = 0
+        self.worker = None
+        self.deadline = None
+        self.done = False
+
+    def key(self):
+        # Highest priority first, then oldest job, then in frame order
+        return (-self.job.priority, self.job.seq, self.index)
+
+    def describe(self):
+        return {
+            'job': self.job.id,
+            'chunk': self.index,
+            'first': self.first,
+            'last': self.last,
+            'attempt': self.attempts,
+        }
+
+
+class Job():
+    def __init__(self, seq, scene, priority, chunkFrames, output):
+        self.seq = seq
+        self.id = str(seq)
+        self.scene = scene
+        self.priority = priority
+        self.output = output
+        self.state = 'queued'
+        self.errors = []
+        self.rendered = set()
+        self.held = set()  # Rendered frames that reuse an earlier frame's image
+        self.submitted = time.time()
+        self.finished = None
+
+        frames = scene['frames']
+        self.chunks = [
+            Chunk(self, i, first, min(first + chunkFrames, frames) - 1)
+            for i, first in enumerate(range(0, frames, chunkFrames))]
+
+    def status(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'priority': self.priority,
+            'frames': self.scene['frames'],
+            'rendered': frameRanges(sorted(self.rendered)),
+            'held': len(self.held),
+            'output': self.output,
+            'errors': self.errors[-10:],
+            'submitted': self.submitted,
+            'finished': self.finished,
+        }
+
+
+class RenderQueue():
+    """
+    Jobs split into chunks of frames, handed out to whichever worker asks
+    next in priority order. A chunk that fails, or whose worker goes quiet
+    for longer than leaseTimeout, is queued again up to maxAttempts times.
+    """
+
+    def __init__(self, outputDir='renders', leaseTimeout=LEASE_TIMEOUT, maxAttempts=MAX_ATTEMPTS):
+        self.outputDir = outputDir
+        self.leaseTimeout = leaseTimeout
+        self.maxAttempts = maxAttempts
+
+        self.jobs = {}
+        self.workers = {}
+        self.pending = []  # Heap of (key, chunk)
+        self.leased = set()
+        self.seq = 0
+        self.version = 0  # Bumped on every change, status long polls wait on it
+        self.changed = threading.Condition()
+
+    def touch(self):
+        self.version += 1
+        self.changed.notify_all()
+
+    def nextId(self):
+        self.seq += 1
+        return self.seq
+
+    def outputFolder(self, output, seq):
+        # Jobs only get to pick a folder under outputDir, relative ones are
+        # taken relative to it
+        root = os.path.realpath(self.outputDir)
+        folder = os.path.realpath(os.path.join(root, output or str(seq)))
+        if os.path.commonpath([root, folder]) != root:
+            raise ValueError(f"output {output} is outside {self.outputDir}")
+        return folder
+
+    def submit(self, scene, priority=0, chunkFrames=CHUNK_FRAMES, output=None):
+        with self.changed:
+            seq = self.nextId()
+            output = self.outputFolder(output, seq)
+            job = Job(seq, scene, int(priority), max(1, int(chunkFrames)), output)
+            os.makedirs(job.output, exist_ok=True)
+
+            self.jobs[job.id] = job
+            for chunk in job.chunks:
+                heapq.heappush(self.pending, (chunk.key(), chunk))
+            self.touch()
+            return job.id
+
+    def cancel(self, jobId):
+        with self.changed:
+            job = self.jobs[jobId]
+            if job.state in ('queued', 'rendering'):
+                job.state = 'cancelled'
+                job.finished = time.time()
+                self.touch()
+
+    def register(self, host, pid):
+        with self.changed:
+            workerId = str(self.nextId())
+            self.workers[workerId] = {'host': host, 'pid': pid, 'seen': time.time(), 'chunks': 0}
+            self.touch()
+            return workerId
+
+    def requeue(self, chunk, error):
+        job = chunk.job
+        chunk.worker = None
+        chunk.deadline = None
+        self.leased.discard(chunk)
+        job.errors.append(f"chunk {chunk.index} attempt {chunk.attempts}: {error}")
+
+        if chunk.attempts >= self.maxAttempts:
+            if job.state in ('queued', 'rendering'):
+                job.state = 'failed'
+                job.finished = time.time()
+        else:
+            heapq.heappush(self.pending, (chunk.key(), chunk))
+
+    def expireLeases(self):
+        now = time.time()
+        for chunk in [c for c in self.leased if c.deadline < now]:
+            self.requeue(chunk, f"worker {chunk.worker} timed out")
+            self.touch()
+
+    def lease(self, workerId):
+        with self.changed:
+            self.workers[workerId]['seen'] = time.time()
+            self.expireLeases()
+
+            while self.pending:
+                key, chunk = heapq.heappop(self.pending)
+                if chunk.done or chunk.job.state not in ('queued', 'rendering'):
+                    continue
+
+                chunk.attempts += 1
+                chunk.worker = workerId
+                chunk.deadline = time.time() + self.leaseTimeout
+                self.leased.add(chunk)
+                chunk.job.state = 'rendering'
+                self.touch()
+                return chunk.describe()
+            return None
+
+    def chunk(self, jobId, index, workerId, frame=None):
+        # The chunk if workerId still holds it, None if it was taken away.
+        # A frame, when given, has to be one of the chunk's
+        chunks = self.jobs[jobId].chunks
+        if not 0 <= index < len(chunks):
+            raise KeyError(f"chunk {index}")
+        chunk = chunks[index]
+        if frame is not None and not chunk.first <= frame <= chunk.last:
+            raise ValueError(f"frame {frame} isn't in chunk {index}")
+        if chunk.worker != workerId or chunk.job.state != 'rendering':
+            return None
+        return chunk
+
+    def frameRendered(self, jobId, index, workerId, frame, data):
+        with self.changed:
+            chunk = self.chunk(jobId, index, workerId, frame)
+            if chunk is None:
+                return False
+            chunk.deadline = time.time() + self.leaseTimeout
+            output = chunk.job.output
+
+        # Written outside the lock to a file of its own
+        with tempfile.NamedTemporaryFile(dir=output, suffix='.part', delete=False) as f:
+            f.write(data)
+        return self.placeFrame(jobId, index, workerId, frame, f.name, held=False)
+
+    def placeFrame(self, jobId, index, workerId, frame, temporary, held):
+        # Moves a finished frame file into place, unless the lease ran out
+        # while it was being written and the chunk went to someone else
+        with self.changed:
+            chunk = self.chunk(jobId, index, workerId)
+            if chunk is None:
+                os.remove(temporary)
+                return False
+            os.replace(temporary, os.path.join(chunk.job.output, f"{frame}.bmp"))
+
+            job = chunk.job
+            job.rendered.add(frame)
+            if held:
+                job.held.add(frame)
+            else:
+                job.held.discard(frame)
+            self.touch()
+        return True
+
+    def frameHeld(self, jobId, index, workerId, frame, source):
+        # Nothing changed since frame source, which this chunk already
+        # delivered, so its file is reused instead of uploaded again
+        with self.changed:
+            chunk = self.chunk(jobId, index, workerId, frame)
+            if chunk is None:
+                return False
+            if not chunk.first <= source < frame or source not in chunk.job.rendered:
+                raise ValueError(f"frame {source} can't stand in for frame {frame}")
+            chunk.deadline = time.time() + self.leaseTimeout
+            output = chunk.job.output
+
+        temporary = stageLink(os.path.join(output, f"{source}.bmp"), output)
+        return self.placeFrame(jobId, index, workerId, frame, temporary, held=True)
+
+    def chunkDone(self, jobId, index, workerId):
+        with self.changed:
+            chunk = self.chunk(jobId, index, workerId)
+            if chunk is None:
+                return False
+
+            chunk.done = True
+            chunk.worker = None
+            self.leased.discard(chunk)
+            self.workers[workerId]['chunks'] += 1
+
+            job = chunk.job
+            if all(c.done for c in job.chunks):
+                job.state = 'done'
+                job.finished = time.time()
+            self.touch()
+            return True
+
+    def chunkFailed(self, jobId, index, workerId, error):
+        with self.changed:
+            chunk = self.chunk(jobId, index, workerId)
+            if chunk is None:
+                return False
+            self.requeue(chunk, f"worker {workerId}: {error}")
+            self.touch()
+            return True
+
+    def status(self, jobId, since=None, timeout=10.0):
+        # Returns straight away, or once something changed after since
+        with self.changed:
+            if since is not None:
+                end = time.time() + timeout
+                while self.version <= since:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        break
+                    self.changed.wait(remaining)
+                    self.expireLeases()
+
+            status = self.jobs[jobId].status()
+            status['version'] = self.version
+            return status
+
+    def summary(self):
+        with self.changed:
+            self.expireLeases()
+            return {
+                'jobs': [job.status() for job in self.jobs.values()],
+                'workers': self.workers,
+                'pending': len(self.pending),
+                'leased': len(self.leased),
+            }
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP:
+
+        POST   /jobs                          {"scene", "priority", "chunk", "output"}
+        GET    /jobs                          queue and worker summary
+        GET    /jobs/<job>?since=<version>    status, long polls when since is given
+        GET    /jobs/<job>/scene              the scene file
+        DELETE /jobs/<job>                    cancel
+        POST   /workers                       {"host", "pid"}, registers a worker
+        POST   /workers/<worker>/lease        next chunk, 204 when there is none
+        PUT    /jobs/<job>/chunks/<n>/frames/<frame>?worker=<worker>   BMP body
+        PUT    /jobs/<job>/chunks/<n>/frames/<frame>?worker=<worker>&same=<frame>
+                                              no body, repeats an earlier frame
+        POST   /jobs/<job>/chunks/<n>/done    {"worker"}
+        POST   /jobs/<job>/chunks/<n>/failed  {"worker", "error"}
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('POST', r'/jobs', 'submit'),
+        ('GET', r'/jobs', 'summary'),
+        ('GET', r'/jobs/(\w+)', 'status'),
+        ('GET', r'/jobs/(\w+)/scene', 'scene'),
+        ('DELETE', r'/jobs/(\w+)', 'cancel'),
+        ('POST', r'/workers', 'register'),
+        ('POST', r'/workers/(\w+)/lease', 'lease'),
+        ('PUT', r'/jobs/(\w+)/chunks/(\d+)/frames/(\d+)', 'frame'),
+        ('POST', r'/jobs/(\w+)/chunks/(\d+)/done', 'done'),
+        ('POST', r'/jobs/(\w+)/chunks/(\d+)/failed', 'failed'),
+    ]
+
+    @property
+    def queue(self):
+        return self.server.queue
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+    def json(self):
+        data = self.body()
+        return json.loads(data) if data else {}
+
+    def reply(self, code, data=None):
+        payload = json.dumps(data).encode() if data is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        self.query = parse_qs(url.query)
+        for routeMethod, pattern, name in self.routes:
+            match = re.fullmatch(pattern, url.path.rstrip('/'))
+            if routeMethod == method and match:
+                try:
+                    getattr(self, 'handle_' + name)(*match.groups())
+                except KeyError as e:
+                    self.reply(404, {'error': f"unknown {e}"})
+                except (ValueError, TypeError) as e:
+                    self.reply(400, {'error': str(e)})
+                return
+        self.reply(404, {'error': f"no route for {method} {url.path}"})
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def handle_submit(self):
+        request = self.json()
+        jobId = self.queue.submit(
+            request['scene'],
+            request.get('priority', 0),
+            request.get('chunk', CHUNK_FRAMES),
+            request.get('output'))
+        self.reply(201, {'id': jobId})
+
+    def handle_summary(self):
+        self.reply(200, self.queue.summary())
+
+    def handle_status(self, jobId):
+        since = self.query.get('since')
+        self.reply(200, self.queue.status(jobId, int(since[0]) if since else None))
+
+    def handle_scene(self, jobId):
+        self.reply(200, self.queue.jobs[jobId].scene)
+
+    def handle_cancel(self, jobId):
+        self.queue.cancel(jobId)
+        self.reply(204)
+
+    def handle_register(self):
+        request = self.json()
+        self.reply(201, {'id': self.queue.register(request.get('host'), request.get('pid'))})
+
+    def handle_lease(self, workerId):
+        chunk = self.queue.lease(workerId)
+        if chunk is None:
+            self.reply(204)
+        else:
+            self.reply(200, chunk)
+
+    def handle_frame(self, jobId, index, frame):
+        workerId = self.query['worker'][0]
+        if 'same' in self.query:
+            self.body()
+            kept = self.queue.frameHeld(
+                jobId, int(index), workerId, int(frame), int(self.query['same'][0]))
+        else:
+            kept = self.queue.frameRendered(jobId, int(index), workerId, int(frame), self.body())
+        self.reply(200 if kept else 409)
+
+    def handle_done(self, jobId, index):
+        kept = self.queue.chunkDone(jobId, int(index), self.json()['worker'])
+        self.reply(200 if kept else 409)
+
+    def handle_failed(self, jobId, index):
+        request = self.json()
+        self.queue.chunkFailed(jobId, int(index), request['worker'], request.get('error'))
+        self.reply(200)
+
+
+class RenderService(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, queue=None, verbose=False):
+        super().__init__(address, RenderHandler)
+        self.queue = queue if queue is not None else RenderQueue()
+        self.verbose = verbose
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render job queue service")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--output', default='renders', help="where job frames go, jobs can only pick folders under it")
+    parser.add_argument('--lease-timeout', type=float, default=LEASE_TIMEOUT)
+    parser.add_argument('--attempts', type=int, default=MAX_ATTEMPTS)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    queue = RenderQueue(args.output, args.lease_timeout, args.attempts)
+    service = RenderService((args.host, args.port), queue, args.verbose)
+    print(f"Render service on http://{args.host}:{args.port}")
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    service.server_close()
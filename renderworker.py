@@ -0,0 +1,150 @@
+import os
+import sys
+import time
+import socket
+import traceback
+
+from renderqueue import DEFAULT_PORT, request
+from assembly import loadGeometry
+from framebuffers import FramePool, PooledOffscreenRenderer
+from scenefile import buildScene, partPose, sceneState
+
+
+class ChunkLost(Exception):
+    # The service gave the chunk to someone else, or the job was cancelled
+    pass
+
+
+class RenderWorker():
+    """
+    Pulls chunks from the render service, renders them with its own
+    offscreen renderer and uploads every frame as it's done. Frames where
+    nothing changed since the one before aren't rendered, the service is
+    told to repeat the earlier frame. Scenes and geometry are kept between
+    chunks so a job only loads its parts once per worker.
+    """
+
+    def __init__(self, server, pollInterval=1.0):
+        self.server = server.rstrip('/')
+        self.pollInterval = pollInterval
+        self.workerId = None
+        self.renderer = None
+        self.geometries = {}
+        self.scenes = {}  # job id -> (description, scene, nodes)
+
+    def register(self):
+        status, reply = request(self.server, 'POST', '/workers', {
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+        })
+        self.workerId = reply['id']
+        print(f"Worker {self.workerId} registered with {self.server}")
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    if self.workerId is None:
+                        self.register()
+                    status, chunk = request(self.server, 'POST', f"/workers/{self.workerId}/lease")
+                except OSError:
+                    # Service not up (yet), keep trying
+                    time.sleep(self.pollInterval)
+                    continue
+
+                if status == 404:
+                    # The service restarted and forgot about us
+                    self.workerId = None
+                elif status == 200:
+                    self.renderChunk(chunk)
+                else:
+                    time.sleep(self.pollInterval)
+        finally:
+            if self.renderer is not None:
+                self.renderer.delete()
+
+    def loadScene(self, jobId):
+        if jobId not in self.scenes:
+            status, description = request(self.server, 'GET', f"/jobs/{jobId}/scene")
+            for part in description['parts']:
+                # Parts are read from the paths the app loaded them from,
+                # workers on other hosts need the same files there
+                source = part['source']
+                if source not in self.geometries:
+                    if not os.path.isfile(source):
+                        raise FileNotFoundError(f"{source} isn't on {socket.gethostname()}")
+                    self.geometries[source] = loadGeometry(source)
+
+            # Only the latest job's scene stays around
+            self.scenes = {jobId: (description,) + buildScene(description, self.geometries)}
+        return self.scenes[jobId]
+
+    def renderChunk(self, chunk):
+        jobId, index = chunk['job'], chunk['chunk']
+        path = f"/jobs/{jobId}/chunks/{index}"
+        print(f"Worker {self.workerId}: job {jobId} frames {chunk['first']}-{chunk['last']}")
+
+        try:
+            description, scene, nodes = self.loadScene(jobId)
+            width, height = description['size']
+            renderer = self.rendererFor(width, height)
+
+            renderedState, renderedFrame = None, None
+            for frame in range(chunk['first'], chunk['last'] + 1):
+                for node, part in zip(nodes, description['parts']):
+                    scene.set_pose(node, pose=partPose(part, frame))
+
+                state = sceneState(scene)
+                if state == renderedState:
+                    status, reply = request(
+                        self.server, 'PUT',
+                        f"{path}/frames/{frame}?worker={self.workerId}&same={renderedFrame}")
+                else:
+                    renderer.render(scene)
+                    renderedState, renderedFrame = state, frame
+
+                    pool = renderer.pool
+                    status, reply = request(
+                        self.server, 'PUT', f"{path}/frames/{frame}?worker={self.workerId}",
+                        pool.header + pool.color.tobytes(), 'image/bmp')
+                if status != 200:
+                    raise ChunkLost()
+
+            request(self.server, 'POST', f"{path}/done", {'worker': self.workerId})
+        except ChunkLost:
+            print(f"Worker {self.workerId}: lost job {jobId} chunk {index}")
+        except Exception:
+            error = traceback.format_exc(limit=3)
+            print(error, file=sys.stderr)
+            request(self.server, 'POST', f"{path}/failed", {'worker': self.workerId, 'error': error})
+
+    def rendererFor(self, width, height):
+        if self.renderer is None:
+            self.renderer = PooledOffscreenRenderer(width, height, pool=FramePool(width, height))
+        self.renderer.viewport_width = width
+        self.renderer.viewport_height = height
+        return self.renderer
+
+
+def runWorker(server):
+    RenderWorker(server).run()
+
+
+if __name__ == '__main__':
+    import argparse
+    import multiprocessing
+
+    parser = argparse.ArgumentParser(description="Render worker, one process per GL context")
+    parser.add_argument('--server', default=f"http://localhost:{DEFAULT_PORT}")
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        runWorker(args.server)
+    else:
+        processes = [multiprocessing.Process(target=runWorker, args=(args.server,))
+                     for i in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
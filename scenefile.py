@@ -0,0 +1,117 @@
+import json
+import numpy as np
+import pyrender
+
+
+SCENE_VERSION = 1
+
+
+def snapshotScene(glWidget, models, frames):
+    """
+    Everything needed to render the animation away from the app, as plain
+    JSON data. Parts refer to their STL by path and carry their resolved
+    pose per frame, or a single pose when they don't move.
+    """
+    scene = glWidget.scene
+    cameraNode = scene.main_camera_node
+
+    lights = []
+    for node in scene.light_nodes:
+        light = node.light
+        lights.append({
+            'type': type(light).__name__,
+            'color': [float(c) for c in light.color],
+            'intensity': float(light.intensity),
+            'range': getattr(light, 'range', None),
+            'pose': scene.get_pose(node).ravel().tolist(),
+        })
+
+    parts = []
+    for mod in models.values():
+        if not mod.showing:
+            continue
+        part = {'source': mod.source, 'color': [float(c) for c in mod.color]}
+        if mod.hasKeyframes():
+            part['poses'] = mod.posesAt(np.arange(frames)).reshape(frames, 16).tolist()
+        else:
+            part['pose'] = mod.poseMatrix().ravel().tolist()
+        parts.append(part)
+
+    return {
+        'version': SCENE_VERSION,
+        'size': [glWidget.width, glWidget.height],
+        'frames': int(frames),
+        'background': [float(c) for c in scene.bg_color],
+        'camera': {
+            'yfov': float(cameraNode.camera.yfov),
+            'pose': scene.get_pose(cameraNode).ravel().tolist(),
+        },
+        'lights': lights,
+        'parts': parts,
+    }
+
+
+def saveScene(fileName, description):
+    with open(fileName, 'w') as f:
+        json.dump(description, f)
+
+
+def loadScene(fileName):
+    with open(fileName) as f:
+        description = json.load(f)
+    if description.get('version') != SCENE_VERSION:
+        raise ValueError(f"{fileName} is not a version {SCENE_VERSION} scene file")
+    return description
+
+
+def partPose(part, frame):
+    if 'poses' in part:
+        poses = part['poses']
+        return np.array(poses[min(frame, len(poses) - 1)]).reshape(4, 4)
+    return np.array(part['pose']).reshape(4, 4)
+
+
+def sceneState(scene):
+    """
+    Everything that decides what a frame of scene looks like, to tell
+    whether anything changed between two frames: the nodes in the scene
+    with their world poses and meshes, cameras, lights and background.
+    Objects compare by identity and are kept alive by the state, so a
+    rebuilt mesh never passes for the old one.
+    """
+    nodes = sorted(scene.nodes, key=id)
+    poses = np.array([scene.get_pose(node) for node in nodes])
+    cameras = tuple((node.camera.yfov, node.camera.aspectRatio) for node in scene.camera_nodes)
+    lights = tuple((tuple(node.light.color), node.light.intensity) for node in scene.light_nodes)
+    return (
+        tuple((node, node.mesh) for node in nodes), poses.tobytes(), cameras, lights,
+        tuple(scene.bg_color), tuple(scene.ambient_light))
+
+
+def buildScene(description, geometries):
+    # geometries maps each part's source to its loaded geometry
+    width, height = description['size']
+    camera = description['camera']
+
+    scene = pyrender.Scene(bg_color=description['background'])
+    scene.add(pyrender.PerspectiveCamera(yfov=camera['yfov'], aspectRatio=width / height),
+              pose=np.array(camera['pose']).reshape(4, 4))
+
+    for light in description['lights']:
+        if light['type'] == 'PointLight':
+            node = pyrender.PointLight(
+                color=light['color'], intensity=light['intensity'], range=light['range'])
+        elif light['type'] == 'SpotLight':
+            node = pyrender.SpotLight(
+                color=light['color'], intensity=light['intensity'], range=light['range'])
+        else:
+            node = pyrender.DirectionalLight(color=light['color'], intensity=light['intensity'])
+        scene.add(node, pose=np.array(light['pose']).reshape(4, 4))
+
+    nodes = []
+    for part in description['parts']:
+        mesh = geometries[part['source']].toPyrender(tuple(part['color']))
+        node = pyrender.Node(mesh=mesh, matrix=partPose(part, 0))
+        scene.add_node(node)
+        nodes.append(node)
+    return scene, nodes
@@ -0,0 +1,130 @@
+import numpy as np
+import pyrender
+
+
+def mergedMesh(parts, light=None):
+    # One world space mesh from (geometry, pose, color) triples. With a light
+    # direction its diffuse shading is baked into the colours, for drawing
+    # unlit
+    vertices = []
+    normals = []
+    faces = []
+    colors = []
+    offset = 0
+    for geometry, pose, color in parts:
+        v = geometry.vertices() @ pose[:3, :3].T + pose[:3, 3]
+        n = geometry.vertexNormals() @ np.linalg.inv(pose[:3, :3])
+        n /= np.linalg.norm(n, axis=1, keepdims=True)
+        vertices.append(v)
+        normals.append(n)
+        faces.append(geometry.faces.astype(np.uint32) + offset)
+
+        c = np.tile(np.asarray(color, dtype=np.float32), (len(v), 1))
+        visibility = geometry.visibility()
+        if visibility is not None:
+            c[:, :3] *= visibility[:, None]
+        if light is not None:
+            c[:, :3] *= (0.35 + 0.65 * np.clip(n @ light, 0, 1))[:, None]
+        colors.append(c)
+        offset += len(v)
+
+    # Parts differ in colour, so a merged mesh is the one place that keeps it per vertex
+    primitive = pyrender.Primitive(
+        positions=np.concatenate(vertices).astype(np.float32),
+        normals=np.concatenate(normals).astype(np.float32),
+        color_0=np.concatenate(colors),
+        indices=np.concatenate(faces),
+        material=pyrender.MetallicRoughnessMaterial(metallicFactor=0.2, roughnessFactor=0.8))
+    return pyrender.Mesh(primitives=[primitive])
+
+
+class StaticBatch():
+    """
+    Merges every model that has no keyframes and hasn't been touched for a
+    while into one world space mesh, so those parts cost a single node and
+    draw call. Members are pulled back out as soon as they are edited,
+    recolored, hidden or keyframed.
+    """
+
+    def __init__(self, scene, settleFrames=30):
+        self.scene = scene
+        self.settleFrames = settleFrames
+
+        self.node = None
+        self.members = {}   # name -> state key the model was baked with
+        self.settling = {}  # name -> (state key, frames unchanged)
+        self.dirty = False
+
+    def stateKey(self, mod):
+        return (mod.translation, mod.rotation, mod.scale, id(mod.node))
+
+    def holds(self, name, mod):
+        return self.members.get(name) == self.stateKey(mod)
+
+    def isBatchable(self, mod, ui):
+        if not mod.showing or mod.node is None or mod.hasKeyframes():
+            return False
+
+        # Still typing into one of the fields, that's a pending edit
+        for field in ('X', 'Y', 'Z', 'RX', 'RY', 'RZ'):
+            if ui[field].hasFocus():
+                return False
+        return True
+
+    def update(self, models, models_ui):
+        for name, mod in models.items():
+            key = self.stateKey(mod)
+            batchable = self.isBatchable(mod, models_ui[name])
+
+            if name in self.members:
+                if batchable and self.members[name] == key:
+                    continue
+                self.evict(name, mod)
+                batchable = False
+
+            if not batchable:
+                self.settling.pop(name, None)
+                continue
+
+            lastKey, frames = self.settling.get(name, (None, 0))
+            frames = frames + 1 if lastKey == key else 0
+
+            if frames >= self.settleFrames:
+                del self.settling[name]
+                self.members[name] = key
+                if self.scene.has_node(mod.node):
+                    self.scene.remove_node(mod.node)
+                self.dirty = True
+            else:
+                self.settling[name] = (key, frames)
+
+        # Models that were deleted out from under us
+        for name in list(self.members):
+            if name not in models:
+                del self.members[name]
+                self.dirty = True
+
+        if self.dirty:
+            self.rebuild(models)
+
+    def evict(self, name, mod):
+        del self.members[name]
+        if mod.showing and mod.node is not None and not self.scene.has_node(mod.node):
+            self.scene.add_node(mod.node)
+            self.scene.set_pose(mod.node, pose=mod.poseMatrix())
+        self.dirty = True
+
+    def rebuild(self, models):
+        self.dirty = False
+
+        if self.node is not None:
+            self.scene.remove_node(self.node)
+            self.node = None
+
+        if not self.members:
+            return
+
+        parts = [(models[name].geometry, models[name].poseMatrix(), models[name].color)
+                 for name in self.members]
+        self.node = pyrender.Node(mesh=mergedMesh(parts), matrix=np.eye(4))
+        self.scene.add_node(self.node)
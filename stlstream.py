@@ -0,0 +1,256 @@
+import os
+import shutil
+import struct
+import tempfile
+import numpy as np
+
+from collections import deque
+
+from geometry import CompactMesh
+
+
+# Binary STL record: normal, three vertices, attribute byte count
+TRIANGLE = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attribute', '<u2')])
+
+# Indexed mesh file: header, uint32 faces, float32 vertices, float32 normals
+INDEXED_MAGIC = b'STLAIDX1'
+INDEXED_HEADER = struct.Struct('<8sQQ')
+INDEXED_SUFFIX = '.stlidx'
+
+# Input files bigger than this are streamed instead of loaded whole
+STREAMING_THRESHOLD = 512 * 1024 * 1024
+MEMORY_BUDGET = 1024 * 1024 * 1024
+
+# Rough working set while processing, used to size chunks and slabs
+BYTES_PER_TRIANGLE = 256
+BYTES_PER_VERTEX = 64
+
+GRID_BITS = 21
+
+
+def triangleCount(fileName):
+    # None for ASCII files, their size never matches the binary layout
+    size = os.path.getsize(fileName)
+    if size < 84:
+        return None
+
+    with open(fileName, 'rb') as f:
+        f.seek(80)
+        count, = struct.unpack('<I', f.read(4))
+
+    if 84 + count * TRIANGLE.itemsize != size:
+        return None
+    return count
+
+
+def isLargeBinaryStl(fileName, threshold=STREAMING_THRESHOLD):
+    return os.path.getsize(fileName) > threshold and triangleCount(fileName) is not None
+
+
+def readChunks(fileName, chunkTriangles):
+    count = triangleCount(fileName)
+    with open(fileName, 'rb') as f:
+        f.seek(84)
+        first = 0
+        while first < count:
+            n = min(chunkTriangles, count - first)
+            yield first, np.fromfile(f, dtype=TRIANGLE, count=n)['vertices']
+            first += n
+
+
+def scanBounds(fileName, chunkTriangles):
+    lo = np.full(3, np.inf)
+    hi = np.full(3, -np.inf)
+    for first, tris in readChunks(fileName, chunkTriangles):
+        v = tris.reshape(-1, 3)
+        lo = np.minimum(lo, v.min(axis=0))
+        hi = np.maximum(hi, v.max(axis=0))
+    return lo, hi
+
+
+class WeldGrid():
+    # Spatial hash grid, every vertex maps to the packed integer coordinates of
+    # its cell and vertices sharing a cell are welded together
+
+    def __init__(self, lo, hi, tolerance=None):
+        cells = (1 << GRID_BITS) - 1
+        finest = float((hi - lo).max()) / cells
+        self.lo = lo
+        self.cellSize = max(tolerance or 0.0, finest) or 1.0
+
+    def keys(self, vertices):
+        q = ((vertices - self.lo) / self.cellSize).astype(np.int64)
+        return (q[:, 0] << (2 * GRID_BITS)) | (q[:, 1] << GRID_BITS) | q[:, 2]
+
+    def slab(self, keys):
+        return keys >> (2 * GRID_BITS)
+
+
+def mergeUnique(keys, positions):
+    keys, index = np.unique(keys, return_index=True)
+    return keys, positions[index]
+
+
+def weldSlab(fileName, chunkTriangles, grid, slab, maxVertices):
+    # Unique cells (and a position for each) in one x slab of the grid,
+    # None if the slab holds more than maxVertices
+    qa, qb = slab
+    keys = np.empty(0, dtype=np.int64)
+    positions = np.empty((0, 3), dtype=np.float32)
+    pendingKeys = []
+    pendingPositions = []
+    pending = 0
+
+    for first, tris in readChunks(fileName, chunkTriangles):
+        v = tris.reshape(-1, 3)
+        k = grid.keys(v)
+        x = grid.slab(k)
+        mask = (x >= qa) & (x < qb)
+        if not mask.any():
+            continue
+
+        k, p = mergeUnique(k[mask], v[mask])
+        pendingKeys.append(k)
+        pendingPositions.append(p)
+        pending += len(k)
+
+        # Merge once the pending pile outgrows what we have, keeps it amortized
+        if pending >= max(len(keys), chunkTriangles):
+            keys, positions = mergeUnique(
+                np.concatenate([keys] + pendingKeys),
+                np.concatenate([positions] + pendingPositions))
+            pendingKeys, pendingPositions, pending = [], [], 0
+
+            if maxVertices is not None and len(keys) > maxVertices:
+                return None
+
+    keys, positions = mergeUnique(
+        np.concatenate([keys] + pendingKeys),
+        np.concatenate([positions] + pendingPositions))
+
+    if maxVertices is not None and len(keys) > maxVertices:
+        return None
+    return keys, positions
+
+
+def indexSlab(fileName, chunkTriangles, grid, slab, keys, offset, faces):
+    # Writes the face indices for every corner in the slab and returns the
+    # area weighted vertex normals of the slab's vertices
+    qa, qb = slab
+    normals = np.zeros((len(keys), 3), dtype=np.float32)
+    corners = faces.reshape(-1)
+
+    for first, tris in readChunks(fileName, chunkTriangles):
+        k = grid.keys(tris.reshape(-1, 3))
+        x = grid.slab(k)
+        inSlab = np.nonzero((x >= qa) & (x < qb))[0]
+        if len(inSlab) == 0:
+            continue
+
+        local = np.searchsorted(keys, k[inSlab])
+        corners[first * 3 + inSlab] = offset + local
+
+        faceNormals = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+        np.add.at(normals, local, faceNormals[inSlab // 3])
+
+    lengths = np.linalg.norm(normals, axis=1)
+    lengths[lengths == 0] = 1
+    normals /= lengths[:, None]
+    return normals
+
+
+def convertStl(fileName, outName, memoryBudget=MEMORY_BUDGET, tolerance=None):
+    """
+    Welds a binary STL into an indexed mesh file without ever holding the
+    whole mesh. The grid is split into x slabs small enough to weld within
+    memoryBudget, each one costs two passes over the input.
+    """
+    count = triangleCount(fileName)
+    if count is None:
+        raise ValueError(f"{fileName} is not a binary STL, can't stream it")
+
+    chunkTriangles = max(1024, memoryBudget // 4 // BYTES_PER_TRIANGLE)
+    maxVertices = max(1024, memoryBudget // 2 // BYTES_PER_VERTEX)
+
+    lo, hi = scanBounds(fileName, chunkTriangles)
+    grid = WeldGrid(lo, hi, tolerance)
+
+    # Closed meshes have about half as many vertices as triangles
+    columns = int(grid.slab(grid.keys(hi[None, :]))[0]) + 1
+    slabCount = min(columns, count // 2 // maxVertices + 1)
+    bounds = np.linspace(0, columns, slabCount + 1).astype(np.int64)
+    slabs = deque(zip(bounds[:-1], bounds[1:]))
+
+    # Only replaces outName once complete, a half written file is never loaded
+    partName = outName + '.part'
+    with open(partName, 'wb') as f:
+        f.write(INDEXED_HEADER.pack(INDEXED_MAGIC, 0, count))
+        f.truncate(INDEXED_HEADER.size + count * 12)
+    faces = np.memmap(partName, dtype='<u4', mode='r+', offset=INDEXED_HEADER.size, shape=(count, 3))
+
+    # Next to the output rather than in /tmp, which may well be RAM backed
+    workDir = os.path.dirname(os.path.abspath(outName))
+    with tempfile.TemporaryFile(dir=workDir) as vertexFile, \
+            tempfile.TemporaryFile(dir=workDir) as normalFile:
+        offset = 0
+        while slabs:
+            qa, qb = slabs.popleft()
+
+            # A single column can't be split any further, let it through
+            welded = weldSlab(fileName, chunkTriangles, grid, (qa, qb),
+                              maxVertices if qb - qa > 1 else None)
+            if welded is None:
+                mid = (qa + qb) // 2
+                slabs.extendleft([(mid, qb), (qa, mid)])
+                continue
+
+            keys, positions = welded
+            normals = indexSlab(fileName, chunkTriangles, grid, (qa, qb), keys, offset, faces)
+
+            positions.astype('<f4').tofile(vertexFile)
+            normals.astype('<f4').tofile(normalFile)
+            offset += len(keys)
+
+        faces.flush()
+        del faces
+
+        with open(partName, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            for part in (vertexFile, normalFile):
+                part.seek(0)
+                shutil.copyfileobj(part, f, 16 * 1024 * 1024)
+            f.seek(0)
+            f.write(INDEXED_HEADER.pack(INDEXED_MAGIC, offset, count))
+
+    os.replace(partName, outName)
+    return offset, count
+
+
+def openIndexedMesh(fileName):
+    with open(fileName, 'rb') as f:
+        magic, vertexCount, faceCount = INDEXED_HEADER.unpack(f.read(INDEXED_HEADER.size))
+    if magic != INDEXED_MAGIC:
+        raise ValueError(f"{fileName} is not an indexed mesh file")
+
+    # Copy on write so nothing downstream can scribble on the file
+    offset = INDEXED_HEADER.size
+    faces = np.memmap(fileName, dtype='<u4', mode='c', offset=offset, shape=(faceCount, 3))
+    offset += faceCount * 12
+    vertices = np.memmap(fileName, dtype='<f4', mode='c', offset=offset, shape=(vertexCount, 3))
+    offset += vertexCount * 12
+    normals = np.memmap(fileName, dtype='<f4', mode='c', offset=offset, shape=(vertexCount, 3))
+    return vertices, normals, faces
+
+
+def loadStreamed(fileName, memoryBudget=MEMORY_BUDGET):
+    # Converts once, later loads map the indexed file and quantize it
+    # straight into compact geometry
+    outName = fileName + INDEXED_SUFFIX
+    if not os.path.exists(outName) or os.path.getmtime(outName) < os.path.getmtime(fileName):
+        print(f"Streaming {fileName} into {outName}")
+        convertStl(fileName, outName, memoryBudget)
+
+    return CompactMesh.fromIndexed(*openIndexedMesh(outName))
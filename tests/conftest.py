@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Headless GL for the tests that need a context, unless a platform was chosen
+if 'PYOPENGL_PLATFORM' not in os.environ and not os.environ.get('DISPLAY'):
+    os.environ['PYOPENGL_PLATFORM'] = 'egl'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+trimesh = pytest.importorskip('trimesh')
+
+from bvh import BVH, MeshBVH
+
+
+def placed(x, y=0.0, z=0.0):
+    transform = np.eye(4)
+    transform[:3, 3] = (x, y, z)
+    return transform
+
+
+@pytest.fixture
+def box():
+    mesh = trimesh.creation.box(extents=(2, 2, 2))
+    return MeshBVH(mesh.vertices, mesh.faces)
+
+
+@pytest.fixture
+def sphere():
+    mesh = trimesh.creation.icosphere(radius=0.3)
+    return MeshBVH(mesh.vertices, mesh.faces)
+
+
+def test_leaves_stay_local():
+    # Splitting ranges at the middle made leaves that straddle two far
+    # apart runs of the Morton order and span most of the mesh
+    mesh = trimesh.creation.icosphere(subdivisions=4, radius=2.0)
+    bvh = MeshBVH(mesh.vertices, mesh.faces)
+    leaves = bvh.leaves()
+    extents = (bvh.hi - bvh.lo)[leaves].max(axis=1)
+    assert np.percentile(extents, 99) < 0.75
+    assert extents.max() < 1.0
+
+    # Nothing on the surface should be a candidate for the centre
+    inside = np.all((bvh.lo[leaves] <= 0) & (bvh.hi[leaves] >= 0), axis=1)
+    assert not inside.any()
+
+
+def test_tree_covers_every_item_once():
+    rng = np.random.default_rng(2)
+    lo = np.concatenate([rng.uniform(0, 1, (500, 3)), np.full((40, 3), 0.5)])
+    hi = lo + rng.uniform(0, 0.01, lo.shape)
+    bvh = BVH(lo, hi, leafSize=4)
+
+    leaves = np.nonzero(bvh.leaves())[0]
+    items, owner = bvh.expandLeaves(leaves)
+    assert sorted(bvh.order[items]) == list(range(len(lo)))
+    assert (bvh.count[leaves] <= 4).all()
+
+    # Every box holds its children, and each leaf holds its items
+    internal = np.nonzero(~bvh.leaves())[0]
+    for child in (bvh.left[internal], bvh.right[internal]):
+        assert (bvh.lo[internal] <= bvh.lo[child]).all()
+        assert (bvh.hi[internal] >= bvh.hi[child]).all()
+    assert (bvh.lo[leaves][owner] <= lo[bvh.order[items]]).all()
+    assert (bvh.hi[leaves][owner] >= hi[bvh.order[items]]).all()
+
+
+def test_crossing_parts_intersect(box, sphere):
+    assert box.intersects(sphere, placed(1.0))
+    assert sphere.intersects(box, placed(-1.0))
+
+
+def test_contained_part_intersects(box, sphere):
+    # No triangles cross at all, the sphere is just inside the box
+    assert box.intersects(sphere, placed(0.2, -0.1, 0.3))
+    assert sphere.intersects(box, placed(-0.2, 0.1, -0.3))
+
+
+def test_separate_parts_with_overlapping_boxes(box, sphere):
+    # In the box's corner, bounding boxes overlap but the surfaces don't
+    assert not box.intersects(sphere, placed(1.25, 1.25, 1.25))
+
+
+def test_faces_in_contact_are_not_interference(box):
+    assert not box.intersects(box, placed(2.0))
+    assert not box.intersects(box, placed(2.0, 2.0))
+
+
+def test_part_inside_a_finely_tessellated_container():
+    # No leaf of the container comes anywhere near the small sphere, so
+    # there isn't a single candidate triangle pair to go on
+    container = trimesh.creation.icosphere(subdivisions=6, radius=2.0)
+    small = trimesh.creation.icosphere(subdivisions=2, radius=0.05)
+    outer = MeshBVH(container.vertices, container.faces)
+    inner = MeshBVH(small.vertices, small.faces)
+
+    rng = np.random.default_rng(0)
+    directions = rng.normal(size=(50, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    transforms = np.tile(np.eye(4), (100, 1, 1))
+    transforms[:50, :3, 3] = directions * rng.uniform(0, 1.8, (50, 1))
+    transforms[50:, :3, 3] = directions * 2.3
+
+    hits = outer.intersectsEach(inner, transforms)
+    assert hits[:50].all()
+    assert not hits[50:].any()
+    assert inner.intersectsEach(outer, np.linalg.inv(transforms[:50])).all()
+
+
+def test_each_placement_matches_single_queries(box, sphere):
+    rng = np.random.default_rng(1)
+    transforms = np.tile(np.eye(4), (40, 1, 1))
+    transforms[:, :3, 3] = rng.uniform(-1.5, 1.5, (40, 3))
+    hits = box.intersectsEach(sphere, transforms)
+    assert hits.tolist() == [box.intersects(sphere, t) for t in transforms]
+    assert hits.any() and not hits.all()
@@ -0,0 +1,150 @@
+import gc
+import time
+import tracemalloc
+
+import numpy as np
+import pytest
+
+pyrender = pytest.importorskip('pyrender')
+trimesh = pytest.importorskip('trimesh')
+
+from framebuffers import PooledOffscreenRenderer
+
+
+WIDTH, HEIGHT = 640, 480
+FRAMES = 50
+
+
+@pytest.fixture
+def scene():
+    scene = pyrender.Scene()
+    scene.add(pyrender.Mesh.from_trimesh(trimesh.creation.icosphere()))
+    pose = np.eye(4)
+    pose[2, 3] = 3.0
+    scene.add(pyrender.PerspectiveCamera(yfov=np.pi / 3.0), pose=pose)
+    scene.add(pyrender.PointLight(intensity=10.0))
+    return scene
+
+
+@pytest.fixture
+def renderer():
+    # Needs an offscreen GL platform (EGL or OSMesa), skipped without one
+    try:
+        renderer = PooledOffscreenRenderer(WIDTH, HEIGHT)
+    except Exception as e:
+        pytest.skip(f"no offscreen GL context: {e}")
+    yield renderer
+    renderer.delete()
+
+
+def moveCamera(scene, frame):
+    # Every frame looks different so a mixed up frame shows
+    node = scene.main_camera_node
+    pose = scene.get_pose(node).copy()
+    pose[0, 3] = 0.05 * frame
+    scene.set_pose(node, pose=pose)
+
+
+def capture(renderer, scene, frames):
+    # {tag: pixels} for every frame that lands in the pool, in order
+    captured = {}
+
+    def keep():
+        tag = renderer.pool.tag
+        if tag is not None:
+            assert tag not in captured
+            captured[tag] = renderer.pool.pixels().copy()
+
+    for i in range(frames):
+        moveCamera(scene, i)
+        renderer.render(scene, tag=i)
+        keep()
+    for tag in renderer.finishAsyncReadback():
+        keep()
+    return captured
+
+
+def measure(renderer, scene, frames):
+    # (retained bytes per frame, peak bytes above the start) over frames renders
+    gc.collect()
+    tracemalloc.start()
+    try:
+        renderer.render(scene)
+        gc.collect()
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        for i in range(frames):
+            renderer.render(scene, tag=i)
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (current - baseline) / frames, peak - baseline
+
+
+def test_render_reuses_the_pool(renderer, scene):
+    renderer.render(scene)
+    color = renderer.pool.color
+    for i in range(5):
+        renderer.render(scene)
+    assert renderer.pool.color is color
+    assert renderer.pool.pixels().shape == (HEIGHT, WIDTH, 3)
+
+
+def test_render_allocations_stay_bounded(renderer, scene):
+    for i in range(5):
+        renderer.render(scene)
+
+    retained, peak = measure(renderer, scene, FRAMES)
+
+    # Nothing piles up from frame to frame, and no frame ever allocates
+    # anything close to a copy of its pixels
+    assert retained < 64
+    assert peak < WIDTH * HEIGHT * 3 // 4
+
+
+@pytest.mark.parametrize('buffers', [2, 3])
+def test_async_readback_matches_sync(renderer, scene, buffers):
+    renderer.render(scene)
+    expected = capture(renderer, scene, 10)
+
+    renderer.startAsyncReadback(buffers)
+    captured = capture(renderer, scene, 10)
+
+    # Each frame comes out exactly once, oldest first, with the same pixels
+    assert list(captured) == list(range(10))
+    for tag in expected:
+        assert np.array_equal(captured[tag], expected[tag]), tag
+    assert renderer._renderer.readback is None
+
+
+def test_async_readback_allocations_stay_bounded(renderer, scene):
+    renderer.startAsyncReadback(3)
+    for i in range(5):
+        renderer.render(scene, tag=i)
+
+    retained, peak = measure(renderer, scene, FRAMES)
+    list(renderer.finishAsyncReadback())
+
+    # Mapping a PBO copies into the pool, never into a fresh array
+    assert retained < 64
+    assert peak < WIDTH * HEIGHT * 3 // 4
+
+
+def test_async_readback_keeps_up_with_sync(renderer, scene):
+    # Software GL gains nothing from the ring, it just mustn't cost anything.
+    # The bound is loose so a busy machine doesn't fail it
+    def framesPerSecond():
+        start = time.perf_counter()
+        for i in range(FRAMES):
+            renderer.render(scene, tag=i)
+        list(renderer.finishAsyncReadback())
+        return FRAMES / (time.perf_counter() - start)
+
+    for i in range(5):
+        renderer.render(scene)
+    sync = framesPerSecond()
+    renderer.startAsyncReadback(3)
+    async_ = framesPerSecond()
+
+    assert async_ > 0.5 * sync
@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import pytest
+
+trimesh = pytest.importorskip('trimesh')
+
+from geometry import CompactMesh, COMPACT_SUFFIX, POSITION_STEPS, loadCompact
+
+
+STL_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stl_files')
+STL_FILES = sorted(name for name in os.listdir(STL_FOLDER) if name.lower().endswith('.stl'))
+
+
+@pytest.fixture(params=STL_FILES)
+def part(request):
+    tmesh = trimesh.load(os.path.join(STL_FOLDER, request.param))
+    return tmesh, CompactMesh.fromTrimesh(tmesh)
+
+
+def angles(a, b):
+    # Degrees between matching unit vectors
+    sine = np.linalg.norm(np.cross(a, b), axis=-1)
+    cosine = np.einsum('...k,...k->...', a, b)
+    return np.degrees(np.arctan2(sine, cosine))
+
+
+def test_positions_within_half_a_step(part):
+    # Every original vertex against its welded, quantized replacement
+    tmesh, geometry = part
+    faces = np.asarray(tmesh.faces)
+    original = np.asarray(tmesh.vertices)[faces]
+    decoded = geometry.vertices()[geometry.faces]
+
+    error = np.abs(decoded - original).max(axis=(0, 1))
+    bound = geometry.extent / POSITION_STEPS / 2 + np.abs(original).max() * np.finfo(np.float32).eps
+    assert (error <= bound).all()
+
+
+def test_normals_within_a_hundredth_of_a_degree(part):
+    tmesh, geometry = part
+    faces = np.asarray(tmesh.faces)
+    normalsIn = np.asarray(tmesh.vertex_normals)[faces]
+    normalsOut = geometry.vertexNormals()[geometry.faces].astype(np.float64)
+    assert angles(normalsIn, normalsOut).max() < 0.01
+
+
+def test_smaller_than_binary_stl(part):
+    tmesh, geometry = part
+    assert geometry.nbytes() < len(geometry.faces) * 50
+
+
+def test_save_load_round_trip(part, tmp_path):
+    tmesh, geometry = part
+    fileName = str(tmp_path / ('part' + COMPACT_SUFFIX))
+    geometry.save(fileName)
+    loaded = CompactMesh.load(fileName)
+
+    assert np.array_equal(loaded.positions, geometry.positions)
+    assert np.array_equal(loaded.normals, geometry.normals)
+    assert np.array_equal(loaded.faces, geometry.faces)
+    assert loaded.faces.dtype.itemsize == geometry.faces.dtype.itemsize
+    assert np.array_equal(loaded.lo, geometry.lo)
+    assert np.array_equal(loaded.extent, geometry.extent)
+    assert np.array_equal(loaded.vertices(), geometry.vertices())
+
+
+def test_load_rejects_other_files(tmp_path):
+    fileName = str(tmp_path / ('part' + COMPACT_SUFFIX))
+    with open(os.path.join(STL_FOLDER, 'xbot.stl'), 'rb') as source, open(fileName, 'wb') as f:
+        f.write(source.read())
+    with pytest.raises(ValueError):
+        CompactMesh.load(fileName)
+
+
+def test_cache_is_written_then_reused(tmp_path):
+    fileName = str(tmp_path / 'xbot.stl')
+    with open(os.path.join(STL_FOLDER, 'xbot.stl'), 'rb') as source, open(fileName, 'wb') as f:
+        f.write(source.read())
+
+    built = []
+
+    def build(name):
+        built.append(name)
+        return CompactMesh.fromTrimesh(trimesh.load(name))
+
+    first = loadCompact(fileName, build)
+    assert os.path.exists(fileName + COMPACT_SUFFIX)
+    second = loadCompact(fileName, build)
+    assert built == [fileName]
+    assert np.array_equal(second.positions, first.positions)
+    assert np.array_equal(second.faces, first.faces)
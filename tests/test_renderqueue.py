@@ -0,0 +1,212 @@
+import os
+import time
+import threading
+
+import pytest
+
+from renderqueue import RenderQueue, RenderService, request
+
+
+@pytest.fixture
+def service(tmp_path):
+    # Factory for a service on a free localhost port, shut down afterwards
+    services = []
+
+    def start(**options):
+        queue = RenderQueue(str(tmp_path / 'renders'), **options)
+        server = RenderService(('localhost', 0), queue)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        services.append(server)
+        return f"http://localhost:{server.server_address[1]}", queue
+
+    yield start
+    for server in services:
+        server.shutdown()
+        server.server_close()
+
+
+def submit(server, frames, priority=0, chunk=5, output=None):
+    job = {'scene': {'frames': frames, 'parts': []}, 'priority': priority, 'chunk': chunk}
+    if output is not None:
+        job['output'] = output
+    status, reply = request(server, 'POST', '/jobs', job)
+    return status, reply and reply['id']
+
+
+def register(server):
+    status, reply = request(server, 'POST', '/workers', {'host': 'test', 'pid': 0})
+    return reply['id']
+
+
+def upload(server, lease, workerId, frame, data=None):
+    path = f"/jobs/{lease['job']}/chunks/{lease['chunk']}/frames/{frame}?worker={workerId}"
+    status, reply = request(server, 'PUT', path, data or f"frame {frame}".encode(), 'image/bmp')
+    return status
+
+
+def finish(server, lease, workerId):
+    status, reply = request(
+        server, 'POST', f"/jobs/{lease['job']}/chunks/{lease['chunk']}/done", {'worker': workerId})
+    return status
+
+
+def waitFor(server, jobId, timeout=30.0):
+    end = time.time() + timeout
+    status = None
+    while time.time() < end:
+        code, status = request(server, 'GET', f"/jobs/{jobId}")
+        if status['state'] in ('done', 'failed', 'cancelled'):
+            return status
+        time.sleep(0.01)
+    raise AssertionError(f"job {jobId} still {status['state']}")
+
+
+class StubWorker(threading.Thread):
+    # Speaks the worker protocol, rendering a frame is just a sleep
+
+    def __init__(self, server, frameTime):
+        super().__init__(daemon=True)
+        self.server = server
+        self.frameTime = frameTime
+        self.stopping = threading.Event()
+
+    def run(self):
+        workerId = register(self.server)
+        while not self.stopping.is_set():
+            status, lease = request(self.server, 'POST', f"/workers/{workerId}/lease")
+            if status != 200:
+                time.sleep(0.01)
+                continue
+            for frame in range(lease['first'], lease['last'] + 1):
+                time.sleep(self.frameTime)
+                upload(self.server, lease, workerId, frame)
+            finish(self.server, lease, workerId)
+
+
+def test_leases_follow_priority_then_submission(service):
+    server, queue = service()
+    low = submit(server, 10, priority=0)[1]
+    high = submit(server, 10, priority=5)[1]
+    later = submit(server, 5, priority=5)[1]
+
+    workerId = register(server)
+    leases = [request(server, 'POST', f"/workers/{workerId}/lease")[1] for i in range(5)]
+    assert [(lease['job'], lease['chunk']) for lease in leases] == [
+        (high, 0), (high, 1), (later, 0), (low, 0), (low, 1)]
+    assert request(server, 'POST', f"/workers/{workerId}/lease")[0] == 204
+
+
+def test_expired_lease_is_retried_and_the_old_worker_ignored(service, tmp_path):
+    server, queue = service(leaseTimeout=0.2, maxAttempts=3)
+    jobId = submit(server, 5)[1]
+
+    first = register(server)
+    lease = request(server, 'POST', f"/workers/{first}/lease")[1]
+    assert lease['attempt'] == 1
+    time.sleep(0.3)
+
+    second = register(server)
+    retry = request(server, 'POST', f"/workers/{second}/lease")[1]
+    assert (retry['job'], retry['chunk'], retry['attempt']) == (jobId, 0, 2)
+
+    # The first worker's uploads no longer land
+    assert upload(server, lease, first, 0, b'stale') == 409
+    for frame in range(5):
+        assert upload(server, retry, second, frame) == 200
+    assert finish(server, lease, first) == 409
+    assert finish(server, retry, second) == 200
+
+    status = waitFor(server, jobId)
+    assert status['state'] == 'done'
+    with open(os.path.join(status['output'], '0.bmp'), 'rb') as f:
+        assert f.read() == b'frame 0'
+    assert not [name for name in os.listdir(status['output']) if name.endswith('.part')]
+
+
+def test_chunk_fails_after_max_attempts(service):
+    server, queue = service(leaseTimeout=0.1, maxAttempts=2)
+    jobId = submit(server, 5)[1]
+    workerId = register(server)
+    for attempt in range(2):
+        assert request(server, 'POST', f"/workers/{workerId}/lease")[1]['attempt'] == attempt + 1
+        time.sleep(0.2)
+
+    # Expiry is noticed on the next lease
+    assert request(server, 'POST', f"/workers/{workerId}/lease")[0] == 204
+    status = request(server, 'GET', f"/jobs/{jobId}")[1]
+    assert status['state'] == 'failed'
+    assert len(status['errors']) == 2
+
+
+def test_frames_outside_the_chunk_are_rejected(service):
+    server, queue = service()
+    submit(server, 10)
+    workerId = register(server)
+    lease = request(server, 'POST', f"/workers/{workerId}/lease")[1]
+
+    assert upload(server, lease, workerId, 7) == 400
+    assert upload(server, {'job': lease['job'], 'chunk': 9}, workerId, 0) == 404
+    assert upload(server, lease, workerId, 4) == 200
+
+
+def test_held_frames_repeat_an_earlier_one(service):
+    server, queue = service()
+    jobId = submit(server, 5)[1]
+    workerId = register(server)
+    lease = request(server, 'POST', f"/workers/{workerId}/lease")[1]
+
+    assert upload(server, lease, workerId, 0) == 200
+    path = f"/jobs/{jobId}/chunks/0/frames/1?worker={workerId}&same=0"
+    assert request(server, 'PUT', path)[0] == 200
+    path = f"/jobs/{jobId}/chunks/0/frames/2?worker={workerId}&same=3"
+    assert request(server, 'PUT', path)[0] == 400
+
+    status = request(server, 'GET', f"/jobs/{jobId}")[1]
+    assert status['held'] == 1
+    with open(os.path.join(status['output'], '1.bmp'), 'rb') as f:
+        assert f.read() == b'frame 0'
+    assert sorted(os.listdir(status['output'])) == ['0.bmp', '1.bmp']
+
+
+def test_output_stays_under_the_output_folder(service, tmp_path):
+    server, queue = service()
+    root = os.path.realpath(tmp_path / 'renders')
+
+    assert submit(server, 5, output='../elsewhere')[0] == 400
+    assert submit(server, 5, output=str(tmp_path / 'elsewhere'))[0] == 400
+    assert submit(server, 5, output='/tmp')[0] == 400
+    assert not os.path.exists(tmp_path / 'elsewhere')
+
+    status, jobId = submit(server, 5, output='shots/take1')
+    assert status == 201
+    output = request(server, 'GET', f"/jobs/{jobId}")[1]['output']
+    assert output == os.path.join(root, 'shots', 'take1')
+    assert os.path.isdir(output)
+
+
+def test_throughput_scales_with_workers(service):
+    # Frames cost the same on every worker, so N workers should get through
+    # a job close to N times faster
+    frameTime = 0.02
+    elapsed = {}
+    for count in (1, 4):
+        server, queue = service()
+        workers = [StubWorker(server, frameTime) for i in range(count)]
+        for worker in workers:
+            worker.start()
+
+        start = time.time()
+        jobId = submit(server, 48, chunk=4)[1]
+        status = waitFor(server, jobId)
+        elapsed[count] = time.time() - start
+
+        for worker in workers:
+            worker.stopping.set()
+        for worker in workers:
+            worker.join()
+
+        assert status['state'] == 'done'
+        assert status['rendered'] == [[0, 47]]
+
+    assert elapsed[1] > 48 * frameTime
+    assert elapsed[1] / elapsed[4] > 2.5
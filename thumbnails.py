@@ -0,0 +1,136 @@
+import threading
+import numpy as np
+import pyrender
+
+from collections import OrderedDict
+
+from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtGui import QImage
+
+
+# One thumbnail renderer at a time, a replaced worker may still be
+# finishing its last frame when the next one starts
+renderLock = threading.Lock()
+
+
+class ThumbnailCache():
+    # Bounded LRU of QImages keyed by (frame, scene fingerprint), shared
+    # between the GUI thread and the worker
+
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        with self.lock:
+            self.images[key] = image
+            self.images.move_to_end(key)
+            while len(self.images) > self.capacity:
+                self.images.popitem(last=False)
+
+
+def sceneFingerprint(models, cameraPose, bgColor):
+    state = [np.asarray(cameraPose).tobytes(), np.asarray(bgColor).tobytes()]
+    for name, mod in sorted(models.items()):
+        if not mod.showing:
+            continue
+        state.append((
+            name,
+            id(mod.geometry),
+            mod.color,
+            mod.scale,
+            mod.translation,
+            mod.rotation,
+            tuple((f, mod.keyframes[f]) for f in mod.keyedFrames)))
+    return hash(tuple(state))
+
+
+class ThumbnailWorker(QThread):
+    """
+    Renders low resolution frames of the animation with its own small
+    offscreen renderer and scene, so it never touches the viewport's GL
+    context. Backs off while the viewport camera is being moved.
+    """
+
+    ready = pyqtSignal(int, QImage)
+
+    def __init__(self, glWidget, models, frames, cache, size=(96, 54), parent=None):
+        super().__init__(parent)
+        self.frames = list(frames)
+        self.cache = cache
+        self.size = size
+        self.isBusy = glWidget.resolution.isInteracting
+
+        # Snapshot everything on the GUI thread, the worker only reads these
+        scene = glWidget.scene
+        cameraNode = scene.main_camera_node
+        self.cameraPose = scene.get_pose(cameraNode)
+        self.yfov = cameraNode.camera.yfov
+        self.bgColor = scene.bg_color
+        self.lights = [(node.light, scene.get_pose(node)) for node in scene.light_nodes]
+
+        self.parts = []
+        frameNumbers = np.asarray(self.frames)
+        for mod in models.values():
+            if mod.showing:
+                self.parts.append((mod.geometry, mod.color, mod.posesAt(frameNumbers)))
+
+        self.fingerprint = sceneFingerprint(models, self.cameraPose, self.bgColor)
+
+    def run(self):
+        with renderLock:
+            self.renderFrames()
+
+    def renderFrames(self):
+        width, height = self.size
+        renderer = None
+
+        for i, frame in enumerate(self.frames):
+            if self.isInterruptionRequested():
+                break
+
+            # Stay out of the way while the user is orbiting
+            while self.isBusy() and not self.isInterruptionRequested():
+                self.msleep(50)
+
+            key = (frame, self.fingerprint)
+            image = self.cache.get(key)
+            if image is None:
+                if renderer is None:
+                    renderer = pyrender.OffscreenRenderer(width, height)
+                    scene, nodes = self.buildScene()
+
+                for node, (geometry, color, poses) in zip(nodes, self.parts):
+                    scene.set_pose(node, pose=poses[i])
+
+                color, depth = renderer.render(scene)
+                color = np.ascontiguousarray(color)
+                image = QImage(color.data, width, height, 3 * width, QImage.Format_RGB888).copy()
+                self.cache.put(key, image)
+
+            self.ready.emit(frame, image)
+
+        if renderer is not None:
+            renderer.delete()
+
+    def buildScene(self):
+        scene = pyrender.Scene(bg_color=self.bgColor)
+        scene.add(pyrender.PerspectiveCamera(yfov=self.yfov, aspectRatio=self.size[0] / self.size[1]),
+                  pose=self.cameraPose)
+        for light, pose in self.lights:
+            scene.add(light, pose=pose)
+
+        nodes = []
+        for geometry, color, poses in self.parts:
+            node = pyrender.Node(mesh=geometry.toPyrender(color), matrix=np.eye(4))
+            scene.add_node(node)
+            nodes.append(node)
+        return scene, nodes
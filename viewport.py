@@ -0,0 +1,48 @@
+import time
+import math
+
+
+class AdaptiveResolution():
+    """
+    Picks the internal render scale for the viewport. While the camera is
+    being moved the scale drifts to whatever holds targetFrameTime, once the
+    input has been idle for idleDelay seconds a full resolution frame is
+    rendered again.
+    """
+
+    def __init__(self, targetFrameTime=1.0/30.0, idleDelay=0.25, minScale=0.25, steps=8):
+        self.targetFrameTime = targetFrameTime
+        self.idleDelay = idleDelay
+        self.minScale = minScale
+        self.steps = steps
+
+        self.scale = 1.0
+        self.lastInput = 0.0
+        self.lastScale = 1.0
+
+    def interact(self):
+        self.lastInput = time.time()
+
+    def isInteracting(self):
+        return time.time() - self.lastInput < self.idleDelay
+
+    def renderScale(self):
+        if self.isInteracting():
+            return self.scale
+        return 1.0
+
+    def renderSize(self, width, height):
+        self.lastScale = self.renderScale()
+        return max(1, int(width * self.lastScale)), max(1, int(height * self.lastScale))
+
+    def frameRendered(self, seconds):
+        if not self.isInteracting() or seconds <= 0:
+            return
+
+        # Render cost goes roughly with the pixel count, so with the square of the scale
+        wanted = self.lastScale * math.sqrt(self.targetFrameTime / seconds)
+        wanted = 0.5 * (self.scale + wanted)
+
+        # Snap to a few steps, every new size reallocates the framebuffers
+        wanted = round(wanted * self.steps) / self.steps
+        self.scale = min(1.0, max(self.minScale, wanted))